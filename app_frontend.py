@@ -1,11 +1,16 @@
 import streamlit as st
 import httpx
-import asyncio
-from typing import Dict, Any
+import json
+import threading
+from cachetools import TTLCache
+from typing import Dict, Any, Iterator, Tuple
 
 # FastAPI backend URL
 API_URL = "http://localhost:8000"
 
+# Chat messages rendered per history page
+HISTORY_PAGE_SIZE = 20
+
 # Page configuration
 st.set_page_config(
     page_title="Agentic RAG + Weather Assistant",
@@ -17,74 +22,85 @@ st.title("🤖 Agentic RAG + Weather Assistant")
 st.markdown("Frontend powered by **Streamlit** | Backend powered by **FastAPI (Async)**")
 
 # ============================================================================
-# ASYNC HELPER FUNCTIONS
+# HTTP HELPER FUNCTIONS
 # ============================================================================
 
-async def check_backend_health_async() -> Dict[str, Any]:
-    """Check if FastAPI backend is healthy (async)."""
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    """Get a shared HTTP client so requests reuse pooled keep-alive connections."""
+    return httpx.Client(base_url=API_URL, timeout=30.0)
+
+@st.cache_data(ttl="30s", show_spinner=False)
+def check_backend_health() -> Dict[str, Any]:
+    """Check if FastAPI backend is healthy (cached for 30s)."""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{API_URL}/health", timeout=5.0)
-            if response.status_code == 200:
-                return response.json()
-            return {"status": "unhealthy", "error": "Backend returned non-200 status"}
+        response = get_http_client().get("/health", timeout=5.0)
+        if response.status_code == 200:
+            return response.json()
+        return {"status": "unhealthy", "error": "Backend returned non-200 status"}
     except Exception as e:
         return {"status": "unhealthy", "error": str(e)}
 
-async def query_backend_async(question: str) -> Dict[str, Any]:
-    """Send query to FastAPI backend (async)."""
+@st.cache_resource
+def get_answer_cache() -> Tuple[TTLCache, threading.Lock]:
+    """Get the cache of successful answers for repeat questions, and its lock.
+    
+    Shared by every session's script thread, and TTLCache isn't thread-safe.
+    """
+    return TTLCache(maxsize=256, ttl=600), threading.Lock()
+
+def stream_backend(question: str, response_data: Dict[str, Any], use_cache: bool = True) -> Iterator[str]:
+    """Stream answer tokens from FastAPI backend, storing the final response in response_data.
+    
+    With use_cache=False the backend skips its cached answers too.
+    """
+    headers = {} if use_cache else {"X-Cache-Bypass": "true"}
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{API_URL}/query",
-                json={"question": question},
-                timeout=30.0
-            )
-            if response.status_code == 200:
-                return response.json()
-            else:
-                return {
+        with get_http_client().stream("POST", "/query/stream", json={"question": question}, headers=headers) as response:
+            if response.status_code != 200:
+                response.read()
+                response_data.update({
                     "error": f"API returned status {response.status_code}",
                     "detail": response.text
-                }
+                })
+                return
+            
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event["type"] == "token":
+                    yield event["content"]
+                elif event["type"] == "result":
+                    response_data.update(event["data"])
+                elif event["type"] == "evaluation":
+                    response_data["evaluation"] = event["data"]
+                elif event["type"] == "error":
+                    response_data["error"] = event["error"]
     except Exception as e:
-        return {"error": str(e)}
+        response_data["error"] = str(e)
 
-async def get_collection_info_async() -> Dict[str, Any]:
-    """Get Qdrant collection info from backend (async)."""
+@st.cache_data(ttl="30s", show_spinner=False)
+def get_collection_info() -> Dict[str, Any]:
+    """Get Qdrant collection info from backend (cached for 30s)."""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{API_URL}/collection", timeout=5.0)
-            if response.status_code == 200:
-                return response.json()
-            return {"error": "Failed to fetch collection info"}
+        response = get_http_client().get("/collection", timeout=5.0)
+        if response.status_code == 200:
+            return response.json()
+        return {"error": "Failed to fetch collection info"}
     except Exception as e:
         return {"error": str(e)}
 
-async def reset_collection_async() -> Dict[str, Any]:
-    """Reset Qdrant collection via backend (async)."""
+def reset_collection() -> Dict[str, Any]:
+    """Reset Qdrant collection via backend."""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.delete(f"{API_URL}/collection", timeout=10.0)
-            if response.status_code == 200:
-                return response.json()
-            return {"error": "Failed to reset collection"}
+        response = get_http_client().delete("/collection", timeout=10.0)
+        if response.status_code == 200:
+            return response.json()
+        return {"error": "Failed to reset collection"}
     except Exception as e:
         return {"error": str(e)}
 
-# Sync wrappers for Streamlit
-def check_backend_health() -> Dict[str, Any]:
-    return asyncio.run(check_backend_health_async())
-
-def query_backend(question: str) -> Dict[str, Any]:
-    return asyncio.run(query_backend_async(question))
-
-def get_collection_info() -> Dict[str, Any]:
-    return asyncio.run(get_collection_info_async())
-
-def reset_collection() -> Dict[str, Any]:
-    return asyncio.run(reset_collection_async())
-
 # ============================================================================
 # SESSION STATE INITIALIZATION - ONE TIME ONLY
 # ============================================================================
@@ -93,29 +109,28 @@ def reset_collection() -> Dict[str, Any]:
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
-# Check health ONLY ONCE on first load
-if "health_status" not in st.session_state:
-    st.session_state.health_status = check_backend_health()
+# Number of recent messages rendered in the chat history
+if "visible_count" not in st.session_state:
+    st.session_state.visible_count = HISTORY_PAGE_SIZE
 
-# Check collection ONLY ONCE on first load
-if "collection_info" not in st.session_state:
-    st.session_state.collection_info = get_collection_info()
+# Health is cached for 30s and shared with the sidebar fragment
+health = check_backend_health()
 
 # ============================================================================
 # SIDEBAR - Backend Status & Controls
 # ============================================================================
 
-with st.sidebar:
+@st.fragment
+def render_sidebar():
+    """Render backend status and controls; widget clicks rerun only this fragment."""
     st.header("⚙️ Backend Status")
     
-    # Use cached health status (only checked once on load)
-    health = st.session_state.health_status
+    health = check_backend_health()
     
     if health.get("status") == "healthy":
         st.success("✅ FastAPI Backend: Online (Async)")
         
-        # Use cached collection info
-        collection_info = st.session_state.collection_info
+        collection_info = get_collection_info()
         if "error" not in collection_info:
             st.metric("Vector Count", collection_info.get('vector_count', 0))
     else:
@@ -129,9 +144,9 @@ with st.sidebar:
     st.header("🎛️ Controls")
     
     if st.button("🔄 Refresh Status"):
-        # Only refresh when button is clicked
-        st.session_state.health_status = check_backend_health()
-        st.session_state.collection_info = get_collection_info()
+        # Drop cached status and rerun the whole app (chat input depends on health)
+        check_backend_health.clear()
+        get_collection_info.clear()
         st.rerun()
     
     if st.button("🗑️ Reset Collection"):
@@ -143,10 +158,13 @@ with st.sidebar:
                 st.success(result.get('message', 'Collection reset successfully'))
                 st.info(result.get('note', ''))
                 # Refresh collection info after reset
-                st.session_state.collection_info = get_collection_info()
+                get_collection_info.clear()
+    
+    st.checkbox("⚡ Reuse cached answers", value=True, key="use_cache", help="Uncheck to always send a fresh query to the backend")
     
     if st.button("🔄 Clear Chat"):
         st.session_state.messages = []
+        st.session_state.visible_count = HISTORY_PAGE_SIZE
         st.rerun()
     
     st.markdown("---")
@@ -160,12 +178,15 @@ with st.sidebar:
 - 📊 LangSmith tracing
 """)
 
+with st.sidebar:
+    render_sidebar()
+
 # ============================================================================
 # MAIN CHAT INTERFACE
 # ============================================================================
 
-# Display ALL previous chat messages from history
-for message in st.session_state.messages:
+def render_message(message: Dict[str, Any]):
+    """Render a single chat message with its metadata details."""
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
         
@@ -200,6 +221,22 @@ for message in st.session_state.messages:
                 # Show full metadata
                 st.json(metadata)
 
+
+@st.fragment
+def render_history():
+    """Render the most recent chat messages; "Load older" reruns only this fragment."""
+    history = st.session_state.messages
+    hidden = len(history) - st.session_state.visible_count
+    
+    if hidden > 0 and st.button(f"⬆️ Load older messages ({hidden} hidden)"):
+        st.session_state.visible_count += HISTORY_PAGE_SIZE
+        hidden -= HISTORY_PAGE_SIZE
+    
+    for message in history[max(hidden, 0):]:
+        render_message(message)
+
+render_history()
+
 # Chat input - Handle new messages
 if prompt := st.chat_input("Ask about weather or documents...", disabled=(health.get("status") != "healthy")):
     
@@ -210,20 +247,25 @@ if prompt := st.chat_input("Ask about weather or documents...", disabled=(health
     with st.chat_message("user"):
         st.markdown(prompt)
     
-    # Step 3: Show thinking indicator and get response
+    # Step 3: Stream the response (or replay a cached one)
     with st.chat_message("assistant"):
-        # Create a placeholder for the thinking indicator
-        thinking_placeholder = st.empty()
-        
-        # Show thinking spinner
-        with thinking_placeholder:
-            with st.spinner("🤔 Thinking..."):
-                response_data = query_backend(prompt)
+        answer_cache, answer_cache_lock = get_answer_cache()
+        use_cache = st.session_state.get("use_cache", True)
+        response_data = None
+        if use_cache:
+            with answer_cache_lock:
+                response_data = answer_cache.get(prompt)
         
-        # Clear the thinking indicator
-        thinking_placeholder.empty()
+        if response_data is not None:
+            st.markdown(response_data.get("answer", "No response generated"))
+        else:
+            response_data = {}
+            st.write_stream(stream_backend(prompt, response_data, use_cache))
+            # Only cache successful answers
+            if "error" not in response_data:
+                with answer_cache_lock:
+                    answer_cache[prompt] = response_data
         
-        # Now show the response directly (no "Complete!" message)
         if "error" in response_data:
             error_msg = f"❌ Error: {response_data['error']}"
             st.error(error_msg)
@@ -234,15 +276,13 @@ if prompt := st.chat_input("Ask about weather or documents...", disabled=(health
                 "content": error_msg
             })
         else:
-            # Display answer
             answer = response_data.get("answer", "No response generated")
-            st.markdown(answer)
             
             # Prepare metadata
             metadata = {
                 "route": response_data.get("route", "unknown"),
                 "evaluation": response_data.get("evaluation", {}),
-                "api_endpoint": f"{API_URL}/query",
+                "api_endpoint": f"{API_URL}/query/stream",
                 "async": True
             }
             
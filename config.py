@@ -17,13 +17,55 @@ os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
 # Qdrant Configuration
 QDRANT_URL = "http://localhost:6333"
 QDRANT_COLLECTION = "pdf_documents"
+QDRANT_PREFER_GRPC = True  # Use gRPC transport (lower per-query latency than REST)
+QDRANT_GRPC_PORT = 6334
+
+# Logging (per-request node messages are DEBUG; set LOG_LEVEL=WARNING in production)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
 # OpenWeather API
 OPENWEATHER_BASE_URL = "http://api.openweathermap.org/data/2.5/weather"
 
+# Embeddings: "openai" (text-embedding-3-small API) or "onnx" (local int8 bge-small,
+# no network round-trip). Switching backends requires re-indexing (DELETE /collection).
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-small"
+LOCAL_EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+LOCAL_EMBEDDING_DIR = "models/bge-small-en-v1.5-int8"  # Exported + quantized on first use
+EMBEDDING_DIM = 384 if EMBEDDING_BACKEND == "onnx" else 1536
+
 # PDF Path
 PDF_PATH = "documents/apj-abdul-kalam-biography.pdf" # Path to PDF document
 
+# Ingestion Configuration
+PDF_EXTRACT_WORKERS = min(os.cpu_count() or 1, 4)  # Worker processes for PDF text extraction
+PDF_MIN_PAGES_PER_WORKER = 50  # Smaller PDFs are extracted in-process (spawning costs more)
+EMBEDDING_BATCH_SIZE = 512  # Chunks per embed_documents call during ingestion
+EMBEDDING_MAX_WORKERS = 8   # Embedding batches in flight at once
+QDRANT_UPLOAD_BATCH_SIZE = 64  # Points per upload request
+QDRANT_UPLOAD_CONCURRENCY = 4  # Upload requests in flight at once
+INGEST_MAX_BATCHES_IN_FLIGHT = 12  # Batches being embedded or waiting to upload (bounds ingest memory)
+QDRANT_INDEXING_THRESHOLD = 20000  # Restored after bulk upload (indexing is off while uploading)
+# OpenAI Batch API: half the embedding cost, but jobs can take up to 24h, so opt-in
+EMBEDDING_USE_BATCH_API = os.getenv("EMBEDDING_USE_BATCH_API", "false").lower() == "true"
+EMBEDDING_BATCH_API_MIN_CHUNKS = 500  # Smaller ingests use the interactive endpoint
+EMBEDDING_BATCH_API_POLL_INTERVAL = 30  # Seconds between batch status checks
+
 # Retrieval Configuration
 RETRIEVAL_TOP_K = 10  # Initial retrieval count
 RERANK_TOP_N = 3      # Final reranked results
+QDRANT_MAX_CONCURRENT_REQUESTS = 2  # In-flight Qdrant requests (latency grows past 2)
+QDRANT_SEARCH_BATCH_SIZE = 16       # Max queries per batch search request
+COHERE_MAX_CONCURRENT_REQUESTS = 64 # In-flight Cohere rerank calls (avoids rate-limit errors)
+BATCH_MAX_CONCURRENT_QUERIES = int(os.getenv("MAX_INFLIGHT", "64"))  # In-flight graph runs per batch query
+
+# Cache Configuration
+GRAPH_CACHE_MAXSIZE = 1024  # Max cached question results
+GRAPH_CACHE_TTL = 600       # Seconds before a cached result expires
+REDIS_URL = os.getenv("REDIS_URL")  # Optional answer cache shared across workers (e.g. redis://localhost:6379/0)
+HEALTH_CACHE_TTL = 5        # Seconds to reuse the /health Qdrant lookup
+RERANK_CACHE_MAXSIZE = 10_000  # Max cached (query, chunk) rerank scores
+RERANK_CACHE_TTL = 900         # Seconds before a cached rerank score expires
+ROUTER_CACHE_MAXSIZE = 10_000  # Max cached router decisions (per normalized question)
+EMBEDDING_CACHE_MAXSIZE = 10_000  # Max cached query embeddings
+EMBEDDING_CACHE_TTL = 900         # Seconds before a cached query embedding expires
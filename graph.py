@@ -18,8 +18,12 @@ def route_question(state: GraphState) -> str:
         return "pdf"
 
 
-def build_graph():
-    """Build and compile the LangGraph workflow."""
+def build_graph(with_evaluation: bool = True):
+    """Build and compile the LangGraph workflow.
+    
+    With with_evaluation=False the graph ends at generation, so callers can
+    return the answer first and evaluate it separately.
+    """
     # Initialize graph
     workflow = StateGraph(GraphState)
     
@@ -28,7 +32,8 @@ def build_graph():
     workflow.add_node("weather", weather_node)
     workflow.add_node("rag_retrieval", rag_retrieval_node)
     workflow.add_node("generation", generation_node)
-    workflow.add_node("evaluation", evaluation_node)
+    if with_evaluation:
+        workflow.add_node("evaluation", evaluation_node)
     
     # Add edges
     workflow.add_edge(START, "router")
@@ -47,11 +52,14 @@ def build_graph():
     workflow.add_edge("weather", "generation")
     workflow.add_edge("rag_retrieval", "generation")
     
-    # Generation leads to evaluation
-    workflow.add_edge("generation", "evaluation")
-    
-    # Evaluation leads to END
-    workflow.add_edge("evaluation", END)
+    if with_evaluation:
+        # Generation leads to evaluation
+        workflow.add_edge("generation", "evaluation")
+        
+        # Evaluation leads to END
+        workflow.add_edge("evaluation", END)
+    else:
+        workflow.add_edge("generation", END)
     
     # Compile graph
     app = workflow.compile()
@@ -59,5 +67,6 @@ def build_graph():
     return app
 
 
-# Create graph instance
+# Create graph instances
 graph_app = build_graph()
+answer_graph_app = build_graph(with_evaluation=False)  # Evaluation runs off the request path
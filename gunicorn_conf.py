@@ -0,0 +1,48 @@
+import os
+
+# Gunicorn configuration for production:
+#   gunicorn main:app -c gunicorn_conf.py
+
+# Bind address (override with BIND, e.g. BIND=0.0.0.0:80)
+bind = os.getenv("BIND", "0.0.0.0:8000")
+
+# One uvicorn event loop per process; 2 * CPU + 1 workers by default so
+# CPU-bound work (JSON serialization, tokenization) scales across cores.
+worker_class = "uvicorn.workers.UvicornWorker"
+workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1))
+
+# Import the app once in the master so workers fork with modules, prompts and
+# config already loaded. Importing opens no connections; clients are built on
+# first use, inside each worker.
+preload_app = True
+
+# Keep idle client connections open across requests (longer than typical LB idle timeouts)
+keepalive = 75
+
+# Requests wait on LLM, Qdrant and Cohere calls, so allow slow responses
+timeout = 120
+graceful_timeout = 30
+
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+accesslog = "-"
+
+
+def on_starting(server):
+    """Ingest the PDF once in the master, before any worker is forked.
+    
+    Each worker's startup check then finds the PDF already stored instead of
+    embedding it again. The clients used here are closed so workers don't
+    inherit their connections.
+    """
+    from config import PDF_PATH
+    from utils import create_vector_store, reset_clients
+    
+    if not os.path.exists(PDF_PATH):
+        return
+    try:
+        create_vector_store(PDF_PATH)
+    except Exception as e:
+        # Workers retry at startup (and report the error through /health)
+        server.log.error("Startup ingestion failed: %s", e)
+    finally:
+        reset_clients()
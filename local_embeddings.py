@@ -0,0 +1,67 @@
+import os
+from typing import List
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+# File name ORTQuantizer gives the quantized model
+QUANTIZED_FILE_NAME = "model_quantized.onnx"
+
+
+def export_quantized_model(model_name: str, save_dir: str):
+    """Export a Hugging Face model to ONNX and quantize it to int8 (dynamic quantization)."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantizer.quantize(
+        save_dir=save_dir,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    )
+    model.config.save_pretrained(save_dir)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(save_dir)
+
+
+class OnnxEmbeddings(Embeddings):
+    """Embeddings from a local int8-quantized ONNX encoder (CLS pooling, L2-normalized).
+
+    The model is exported and quantized into model_dir on first use, then
+    loaded from disk on later startups.
+    """
+
+    def __init__(self, model_name: str, model_dir: str, batch_size: int = 32):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        if not os.path.exists(os.path.join(model_dir, QUANTIZED_FILE_NAME)):
+            export_quantized_model(model_name, model_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name=QUANTIZED_FILE_NAME,
+            provider="CPUExecutionProvider"
+        )
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in fixed-size batches."""
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            inputs = self.tokenizer(
+                texts[i:i + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=512,
+                return_tensors="np"
+            )
+            cls = self.model(**inputs).last_hidden_state[:, 0]
+            cls = cls / np.linalg.norm(cls, axis=1, keepdims=True)
+            vectors.extend(cls.tolist())
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a single query."""
+        return self.embed_documents([text])[0]
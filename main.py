@@ -1,22 +1,67 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, ConfigDict  # ✅ Add ConfigDict
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Literal
 import uvicorn
 import asyncio
+from contextlib import asynccontextmanager
+import hashlib
+import logging
+import time
+import orjson
+from types import MappingProxyType
+from cachetools import TTLCache
 from concurrent.futures import ThreadPoolExecutor
-from graph import graph_app
-from utils import create_vector_store, get_vector_store
-from config import PDF_PATH, QDRANT_URL, QDRANT_COLLECTION
-from qdrant_client import QdrantClient
-from qdrant_client.async_qdrant_client import AsyncQdrantClient
+from graph import answer_graph_app
+from nodes import evaluation_node, evaluate_batch, close_http_client
+from utils import create_vector_store, get_vector_store, get_qdrant_client, reset_clients, embed_queries
+from config import (
+    PDF_PATH,
+    QDRANT_URL,
+    QDRANT_COLLECTION,
+    QDRANT_MAX_CONCURRENT_REQUESTS,
+    BATCH_MAX_CONCURRENT_QUERIES,
+    GRAPH_CACHE_MAXSIZE,
+    GRAPH_CACHE_TTL,
+    HEALTH_CACHE_TTL,
+    LOG_LEVEL,
+    REDIS_URL
+)
 import os
 
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger(__name__)
+
+# ============================================================================
+# LIFESPAN (STARTUP/SHUTDOWN)
+# ============================================================================
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialize vector store on startup and clean up on shutdown."""
+    log.info("🚀 Starting Async Agentic RAG + Weather API...")
+    # Nodes offload blocking clients with asyncio.to_thread (the default executor)
+    asyncio.get_running_loop().set_default_executor(executor)
+    await initialize_vector_store()
+    
+    yield
+    
+    log.info("👋 Shutting down API...")
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await close_http_client()
+    if redis_client is not None:
+        await redis_client.aclose()
+    executor.shutdown(wait=True)
+    reset_clients()
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="Agentic RAG + Weather Assistant API",
     description="Async API for weather queries and document Q&A using RAG with Qdrant and Cohere reranking",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Add CORS middleware
@@ -28,8 +73,48 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Thread pool for CPU-bound operations
-executor = ThreadPoolExecutor(max_workers=4)
+# Thread pool for blocking calls (sized for I/O-bound work)
+executor = ThreadPoolExecutor(max_workers=min(32, 4 * (os.cpu_count() or 1)))
+
+# Initial graph state shared by every request (nodes never mutate it in place)
+EMPTY_STATE = MappingProxyType({
+    "route": "",
+    "context": "",
+    "weather_data": {},
+    "retrieved_docs": [],
+    "rerank_scores": [],
+    "rerank": True,
+    "question_embedding": [],
+    "generation": "",
+    "evaluation": {}
+})
+
+# Keep caches and reverse proxies (e.g. nginx) from buffering streamed tokens
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# Background evaluation tasks (kept referenced until they finish)
+background_tasks = set()
+
+# Cache of graph results keyed on normalized question hash
+graph_cache = TTLCache(maxsize=GRAPH_CACHE_MAXSIZE, ttl=GRAPH_CACHE_TTL)
+
+# Optional Redis cache of graph results shared by all workers (enabled by REDIS_URL)
+if REDIS_URL:
+    import redis.asyncio as redis
+    redis_client = redis.from_url(REDIS_URL)
+else:
+    redis_client = None
+
+# Short-lived cache of Qdrant health for frequently polled /health
+health_cache = TTLCache(maxsize=1, ttl=HEALTH_CACHE_TTL)
+
+# Calls on the shared Qdrant client (get_qdrant_client, built on first use in
+# each worker) are offloaded with asyncio.to_thread so they never block the event loop.
+qdrant_semaphore = asyncio.Semaphore(QDRANT_MAX_CONCURRENT_REQUESTS)
+
+# Bounds graph runs in flight across all batch queries, so large batches keep a
+# steady number of OpenAI/Cohere calls open instead of starting them all at once
+batch_semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENT_QUERIES)
 
 
 # ============================================================================
@@ -38,11 +123,13 @@ executor = ThreadPoolExecutor(max_workers=4)
 
 class QueryRequest(BaseModel):
     question: str
+    rerank: bool = True
     
     model_config = ConfigDict(  # ✅ New way
         json_schema_extra={
             "example": {
-                "question": "What's the weather in Mumbai?"
+                "question": "What's the weather in Mumbai?",
+                "rerank": True
             }
         }
     )
@@ -96,76 +183,206 @@ async def run_in_executor(func, *args):
     return await loop.run_in_executor(executor, func, *args)
 
 
+async def run_qdrant(func, *args):
+    """Run a blocking Qdrant call in a thread, bounding in-flight requests."""
+    async with qdrant_semaphore:
+        return await asyncio.to_thread(func, *args)
+
+
 async def initialize_vector_store():
     """Initialize vector store asynchronously."""
     if os.path.exists(PDF_PATH):
         try:
-            print(f"📚 Initializing Qdrant with PDF: {PDF_PATH}")
+            log.info("📚 Initializing Qdrant with PDF: %s", PDF_PATH)
             # Run blocking operation in thread pool
             await run_in_executor(create_vector_store, PDF_PATH)
             
-            # Use async client
-            async_client = AsyncQdrantClient(url=QDRANT_URL)
-            collection_info = await async_client.get_collection(QDRANT_COLLECTION)
+            # Query the shared client off the event loop
+            collection_info = await run_qdrant(get_qdrant_client().get_collection, QDRANT_COLLECTION)
             doc_count = collection_info.points_count
-            await async_client.close()
             
-            print(f"✅ Qdrant ready with {doc_count} document chunks")
+            log.info("✅ Qdrant ready with %d document chunks", doc_count)
             return True
         except Exception as e:
-            print(f"❌ Error initializing Qdrant: {e}")
+            log.error("❌ Error initializing Qdrant: %s", e)
             return False
     else:
-        print(f"⚠️ PDF not found at {PDF_PATH}")
+        log.warning("⚠️ PDF not found at %s", PDF_PATH)
         return False
 
 
 async def get_qdrant_info():
-    """Get Qdrant collection info asynchronously."""
+    """Get Qdrant collection info asynchronously (cached for a few seconds)."""
+    info = health_cache.get("info")
+    if info is not None:
+        return info
+    
     try:
-        async_client = AsyncQdrantClient(url=QDRANT_URL)
-        collection_info = await async_client.get_collection(QDRANT_COLLECTION)
+        collection_info = await run_qdrant(get_qdrant_client().get_collection, QDRANT_COLLECTION)
         doc_count = collection_info.points_count
-        await async_client.close()
-        return doc_count, "healthy"
+        info = (doc_count, "healthy")
     except Exception as e:
-        return 0, f"unhealthy: {str(e)}"
-
-
-async def process_query_async(question: str):
-    """Process query asynchronously in thread pool."""
-    # LangGraph is synchronous, so run in thread pool
-    def invoke_graph():
-        return graph_app.invoke({
-            "question": question,
-            "route": "",
-            "context": "",
-            "weather_data": {},
-            "retrieved_docs": [],
-            "rerank_scores": [],
-            "generation": "",
-            "evaluation": {}
-        })
+        info = (0, f"unhealthy: {str(e)}")
     
-    return await run_in_executor(invoke_graph)
+    health_cache["info"] = info
+    return info
 
 
-# ============================================================================
-# STARTUP/SHUTDOWN EVENTS
-# ============================================================================
+def question_cache_key(question: str) -> str:
+    """Hash a normalized question (lowercased, whitespace collapsed) for use as a cache key."""
+    return hashlib.sha1(" ".join(question.lower().split()).encode("utf-8")).hexdigest()
 
-@app.on_event("startup")
-async def startup_event():
-    """Initialize vector store on startup."""
-    print("🚀 Starting Async Agentic RAG + Weather API...")
-    await initialize_vector_store()
 
+def redis_cache_key(key: tuple) -> str:
+    """Build the Redis key for a (question hash, rerank) graph cache key."""
+    question_hash, rerank = key
+    return f"answer:{question_hash}:{int(rerank)}"
 
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Cleanup on shutdown."""
-    print("👋 Shutting down API...")
-    executor.shutdown(wait=True)
+
+async def get_cached_result(key: tuple) -> Optional[dict]:
+    """Get a cached graph result, checking this process first and then Redis."""
+    result = graph_cache.get(key)
+    if result is None and redis_client is not None:
+        try:
+            payload = await redis_client.get(redis_cache_key(key))
+        except Exception as e:
+            log.warning("⚠️ Redis cache read failed: %s", e)
+            payload = None
+        if payload is not None:
+            result = orjson.loads(payload)
+            graph_cache[key] = result
+    return result
+
+
+async def store_result(key: tuple, result: dict):
+    """Cache a graph result in this process and, if enabled, in Redis.
+    
+    Stored again once its evaluation is attached, so other workers see the scores.
+    """
+    # Don't cache failed API calls (nodes report errors through the context)
+    if result.get("context", "").startswith("Error"):
+        return
+    
+    # The question embedding is only needed while the graph runs
+    cached = {name: value for name, value in result.items() if name != "question_embedding"}
+    graph_cache[key] = cached
+    if redis_client is not None:
+        try:
+            await redis_client.set(redis_cache_key(key), orjson.dumps(cached), ex=GRAPH_CACHE_TTL)
+        except Exception as e:
+            log.warning("⚠️ Redis cache write failed: %s", e)
+
+
+def run_in_background(coro):
+    """Schedule a coroutine without awaiting it, keeping it referenced until done."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def process_query_async(
+    question: str,
+    rerank: bool = True,
+    question_embedding: Optional[List[float]] = None,
+    evaluate: bool = True,
+    use_cache: bool = True
+):
+    """Process query asynchronously, reusing cached results.
+    
+    With evaluate=False the caller is responsible for scoring the answer.
+    With use_cache=False the graph always runs (the fresh result is still cached).
+    """
+    key = (question_cache_key(question), rerank)
+    cached = await get_cached_result(key) if use_cache else None
+    if cached is not None:
+        log.debug("⚡ Cache hit for: %s", question)
+        return cached
+    
+    result = await answer_graph_app.ainvoke({
+        **EMPTY_STATE,
+        "question": question,
+        "rerank": rerank,
+        "question_embedding": question_embedding or []
+    })
+    await store_result(key, result)
+    
+    # Score the answer without making the caller wait for it
+    if evaluate:
+        run_in_background(evaluate_result(result, key))
+    
+    return result
+
+
+async def evaluate_result(result: dict, key: tuple) -> dict:
+    """Evaluate a generated answer, attach the scores and re-cache it under key (unless evaluation failed)."""
+    update = await evaluation_node(result)
+    result.update(update)
+    # A failed evaluation isn't cached, so a later request retries it
+    if "error" not in update["evaluation"]:
+        await store_result(key, result)
+    return update["evaluation"]
+
+
+async def evaluate_results(results: List[dict], keys: List[tuple]):
+    """Evaluate several generated answers in one batched call, attach the scores and re-cache them."""
+    evaluations = await evaluate_batch(results)
+    for result, key, evaluation in zip(results, keys, evaluations):
+        result["evaluation"] = evaluation
+        if "error" not in evaluation:
+            await store_result(key, result)
+
+
+def build_query_response(question: str, result: dict) -> QueryResponse:
+    """Build the API response from a final graph state."""
+    return QueryResponse(
+        question=question,
+        answer=result.get("generation", "No response generated"),
+        route=result.get("route", "unknown"),
+        context=result.get("context", ""),
+        weather_data=result.get("weather_data") if result.get("route") == "weather" else None,
+        retrieved_docs=result.get("retrieved_docs") if result.get("route") == "pdf" else None,
+        rerank_scores=result.get("rerank_scores") if result.get("route") == "pdf" else None,
+        evaluation=result.get("evaluation", {})
+    )
+
+
+def ndjson_event(event_type: str, **payload) -> bytes:
+    """Serialize a single streaming event as one NDJSON line."""
+    return orjson.dumps({"type": event_type, **payload}) + b"\n"
+
+
+async def stream_query_events(question: str, rerank: bool = True, use_cache: bool = True):
+    """Stream generation tokens as they arrive, then the full query result."""
+    key = (question_cache_key(question), rerank)
+    try:
+        result = await get_cached_result(key) if use_cache else None
+        if result is not None:
+            log.debug("⚡ Cache hit for: %s", question)
+            yield ndjson_event("token", content=result.get("generation", ""))
+        else:
+            result = {**EMPTY_STATE, "question": question, "rerank": rerank}
+            async for mode, chunk in answer_graph_app.astream(dict(result), stream_mode=["messages", "updates"]):
+                if mode == "messages":
+                    # Only forward tokens of the final answer, not router/evaluation output
+                    message, metadata = chunk
+                    if metadata.get("langgraph_node") == "generation" and message.content:
+                        yield ndjson_event("token", content=message.content)
+                else:
+                    for update in chunk.values():
+                        result.update(update or {})
+            
+            await store_result(key, result)
+        
+        yield ndjson_event("result", data=build_query_response(question, result).model_dump(exclude_none=True))
+        
+        # The answer is already delivered; evaluation scores follow as a separate event
+        if not result.get("evaluation"):
+            evaluation = await evaluate_result(result, key)
+            yield ndjson_event("evaluation", data=evaluation)
+    
+    except Exception as e:
+        yield ndjson_event("error", error=f"Error processing query: {str(e)}")
 
 
 # ============================================================================
@@ -182,6 +399,8 @@ async def root():
         "endpoints": {
             "health": "/health",
             "query": "/query (POST)",
+            "query_stream": "/query/stream (POST, NDJSON)",
+            "batch_query": "/query/batch (POST)",
             "collection": "/collection",
             "docs": "/docs"
         }
@@ -203,12 +422,19 @@ async def health_check():
     )
 
 
-@app.post("/query", response_model=QueryResponse, tags=["Query"])
-async def query(request: QueryRequest):
+@app.post("/query", response_model=QueryResponse, response_model_exclude_none=True, tags=["Query"])
+async def query(
+    request: QueryRequest,
+    eval_mode: Literal["async", "sync"] = Query("async", alias="eval"),
+    x_cache_bypass: bool = Header(False)
+):
     """
     Process a query asynchronously - routes to either weather API or document RAG.
     
     - **question**: The user's question (weather or document-related)
+    - **rerank**: Rerank retrieved chunks with Cohere (default: true)
+    - **eval** (query param): `sync` evaluates the answer before responding (for debugging)
+    - **X-Cache-Bypass** (header): `true` skips cached answers and reruns the graph
     
     Returns:
     - **answer**: Generated response
@@ -217,34 +443,54 @@ async def query(request: QueryRequest):
     - **weather_data**: Weather API data (if weather route)
     - **retrieved_docs**: Retrieved document chunks (if pdf route)
     - **rerank_scores**: Cohere reranking scores (if pdf route)
-    - **evaluation**: Quality evaluation scores
+    - **evaluation**: Quality evaluation scores (computed in the background; empty
+      until a cached repeat of the question, unless `eval=sync`)
     """
     try:
         # Process query asynchronously
-        result = await process_query_async(request.question)
-        
-        return QueryResponse(
-            question=request.question,
-            answer=result.get("generation", "No response generated"),
-            route=result.get("route", "unknown"),
-            context=result.get("context", ""),
-            weather_data=result.get("weather_data") if result.get("route") == "weather" else None,
-            retrieved_docs=result.get("retrieved_docs") if result.get("route") == "pdf" else None,
-            rerank_scores=result.get("rerank_scores") if result.get("route") == "pdf" else None,
-            evaluation=result.get("evaluation", {})
+        sync_eval = eval_mode == "sync"
+        result = await process_query_async(
+            request.question, request.rerank, evaluate=not sync_eval, use_cache=not x_cache_bypass
         )
+        
+        # Debug mode: score inline so the response includes the evaluation
+        if sync_eval and not result.get("evaluation"):
+            await evaluate_result(result, (question_cache_key(request.question), request.rerank))
+        
+        return build_query_response(request.question, result)
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
 
 
+@app.post("/query/stream", tags=["Query"])
+@app.post("/query-stream", tags=["Query"], include_in_schema=False)
+async def query_stream(request: QueryRequest, x_cache_bypass: bool = Header(False)):
+    """
+    Process a query and stream the answer as newline-delimited JSON events.
+    
+    - **question**: The user's question (weather or document-related)
+    - **rerank**: Rerank retrieved chunks with Cohere (default: true)
+    - **X-Cache-Bypass** (header): `true` skips cached answers and reruns the graph
+    
+    Streams:
+    - `{"type": "token", "content": ...}` for each generated token
+    - `{"type": "result", "data": ...}` with the full `/query` response once done
+    - `{"type": "evaluation", "data": ...}` with quality scores after the answer
+    - `{"type": "error", "error": ...}` if processing fails
+    """
+    return StreamingResponse(
+        stream_query_events(request.question, request.rerank, use_cache=not x_cache_bypass),
+        media_type="application/x-ndjson",
+        headers=STREAM_HEADERS
+    )
+
+
 @app.get("/collection", response_model=CollectionInfo, tags=["Collection"])
 async def get_collection_info():
     """Get information about the Qdrant collection asynchronously."""
     try:
-        async_client = AsyncQdrantClient(url=QDRANT_URL)
-        collection_info = await async_client.get_collection(QDRANT_COLLECTION)
-        await async_client.close()
+        collection_info = await run_qdrant(get_qdrant_client().get_collection, QDRANT_COLLECTION)
         
         return CollectionInfo(
             collection_name=QDRANT_COLLECTION,
@@ -259,9 +505,8 @@ async def get_collection_info():
 async def reset_collection():
     """Delete and reset the Qdrant collection asynchronously."""
     try:
-        async_client = AsyncQdrantClient(url=QDRANT_URL)
-        await async_client.delete_collection(QDRANT_COLLECTION)
-        await async_client.close()
+        await run_qdrant(get_qdrant_client().delete_collection, QDRANT_COLLECTION)
+        health_cache.clear()
         
         return {
             "message": f"Collection '{QDRANT_COLLECTION}' deleted successfully",
@@ -277,6 +522,7 @@ async def reset_collection():
 
 class BatchQueryRequest(BaseModel):
     questions: List[str]
+    rerank: bool = True
 
 
 class BatchQueryResponse(BaseModel):
@@ -284,21 +530,63 @@ class BatchQueryResponse(BaseModel):
     total_time: float
 
 
-@app.post("/batch-query", response_model=BatchQueryResponse, tags=["Query"])
-async def batch_query(request: BatchQueryRequest):
+@app.post("/query/batch", response_model=BatchQueryResponse, response_model_exclude_none=True, tags=["Query"])
+@app.post("/batch-query", response_model=BatchQueryResponse, response_model_exclude_none=True, tags=["Query"], include_in_schema=False)
+async def batch_query(request: BatchQueryRequest, x_cache_bypass: bool = Header(False)):
     """
     Process multiple queries concurrently (async advantage).
     
     - **questions**: List of questions to process
+    - **rerank**: Rerank retrieved chunks with Cohere (default: true)
+    - **X-Cache-Bypass** (header): `true` skips cached answers and reruns every graph
     
     Returns list of answers processed in parallel.
     """
-    import time
     start_time = time.time()
     
-    # Process all queries concurrently
-    tasks = [process_query_async(question) for question in request.questions]
-    results = await asyncio.gather(*tasks, return_exceptions=True)
+    # Questions that normalize to the same cache key run the graph once.
+    # Looking answers up here also copies Redis hits into this worker's cache.
+    keys = [(question_cache_key(q), request.rerank) for q in request.questions]
+    unique = {}
+    for key, question in zip(keys, request.questions):
+        unique.setdefault(key, question)
+    if x_cache_bypass:
+        cached = [None] * len(unique)
+    else:
+        cached = await asyncio.gather(*(get_cached_result(key) for key in unique))
+    uncached = {key for key, result in zip(unique, cached) if result is None}
+    
+    # Embed all uncached questions in one API call instead of one per graph run
+    question_embeddings = {}
+    if uncached:
+        uncached_questions = [unique[key] for key in uncached]
+        try:
+            vectors = await run_in_executor(embed_queries, uncached_questions)
+            question_embeddings = dict(zip(uncached_questions, vectors))
+        except Exception as e:
+            log.warning("⚠️ Batch embedding failed, embedding per query: %s", e)
+    
+    # Process queries concurrently, with a bounded number of graph runs in flight
+    async def process_bounded(question: str):
+        async with batch_semaphore:
+            return await process_query_async(
+                question, request.rerank, question_embeddings.get(question),
+                evaluate=False, use_cache=not x_cache_bypass
+            )
+    
+    tasks = [process_bounded(question) for question in unique.values()]
+    results_by_key = dict(zip(unique, await asyncio.gather(*tasks, return_exceptions=True)))
+    
+    # Score all freshly generated answers with one batched evaluation call
+    fresh = [
+        (result, key) for key, result in results_by_key.items()
+        if key in uncached and not isinstance(result, Exception)
+    ]
+    if fresh:
+        fresh_results, fresh_keys = zip(*fresh)
+        run_in_background(evaluate_results(list(fresh_results), list(fresh_keys)))
+    
+    results = [results_by_key[key] for key in keys]
     
     responses = []
     for question, result in zip(request.questions, results):
@@ -334,11 +622,19 @@ async def batch_query(request: BatchQueryRequest):
 # ============================================================================
 
 if __name__ == "__main__":
+    # One worker by default for development (`uvicorn main:app --reload` also works);
+    # set WEB_CONCURRENCY for more, or use `gunicorn main:app -c gunicorn_conf.py` in production
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    if workers > 1 and os.path.exists(PDF_PATH):
+        # Ingest once here, so each worker's startup check finds the PDF already stored
+        create_vector_store(PDF_PATH)
+        reset_clients()
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
-        log_level="info",
-        workers=1  # Use 1 worker for development, increase for production
+        loop="auto",  # uvloop where installed (not on Windows), else the default asyncio loop
+        http="httptools",  # C-based HTTP parser instead of pure-Python h11
+        log_level=LOG_LEVEL.lower(),
+        workers=workers
     )
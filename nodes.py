@@ -1,17 +1,108 @@
-import requests
-from typing import TypedDict, Literal, List
+import re
+import asyncio
+import logging
+import httpx
+import cohere
+from functools import lru_cache
+from cachetools import LRUCache
+from typing import TypedDict, Literal, List, Optional
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from pydantic import BaseModel, Field
 from config import (
     OPENWEATHER_API_KEY, 
     OPENWEATHER_BASE_URL, 
     OPENAI_API_KEY,
     COHERE_API_KEY,
     RETRIEVAL_TOP_K,
-    RERANK_TOP_N
+    RERANK_TOP_N,
+    ROUTER_CACHE_MAXSIZE,
+    COHERE_MAX_CONCURRENT_REQUESTS
 )
-from utils import get_vector_store
+from utils import search_documents_batch
+from rerank_cache import get_cached_scores, store_scores
+
+
+log = logging.getLogger(__name__)
+
+# Questions matching these keywords are routed to weather without an LLM call
+WEATHER_KEYWORD_PATTERN = re.compile(
+    r"\b(weather|temperature|forecast|climate|humidity|rain|snow|wind)\b", re.IGNORECASE
+)
+
+# Common cities matched locally so most weather questions skip the location LLM call
+CITY_GAZETTEER = (
+    "Mumbai", "Delhi", "New Delhi", "Bangalore", "Bengaluru", "Kolkata", "Chennai",
+    "Hyderabad", "Pune", "Ahmedabad", "Jaipur", "Lucknow", "Kanpur", "Nagpur",
+    "Indore", "Bhopal", "Patna", "Surat", "Chandigarh", "Kochi", "Goa",
+    "Visakhapatnam", "Thiruvananthapuram", "Rameswaram", "Guwahati", "Noida", "Gurgaon",
+    "London", "Paris", "Berlin", "Madrid", "Rome", "Amsterdam", "Dublin", "Moscow",
+    "Istanbul", "Dubai", "Singapore", "Tokyo", "Beijing", "Shanghai", "Hong Kong",
+    "Seoul", "Bangkok", "Sydney", "Melbourne", "Toronto", "Vancouver", "New York",
+    "Los Angeles", "San Francisco", "Chicago", "Boston", "Seattle", "Washington",
+    "Mexico City", "Sao Paulo", "Cairo", "Nairobi", "Johannesburg", "Karachi",
+    "Lahore", "Dhaka", "Kathmandu", "Colombo"
+)
+CITY_NAMES = {city.lower(): city for city in CITY_GAZETTEER}
+
+# Longest names first, so "New Delhi" wins over "Delhi"
+CITY_PATTERN = re.compile(
+    r"\b(" + "|".join(map(re.escape, sorted(CITY_GAZETTEER, key=len, reverse=True))) + r")\b",
+    re.IGNORECASE
+)
+
+# Punctuation stripped when normalizing questions for the router cache
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+
+# Quoted phrases or bare PDF filenames skip the Cohere cross-encoder
+LITERAL_QUERY_PATTERN = re.compile(r'"[^"]+"|\S+\.pdf', re.IGNORECASE)
+
+# Bounds concurrent rerank calls when a batch of queries reranks at once
+rerank_semaphore = asyncio.Semaphore(COHERE_MAX_CONCURRENT_REQUESTS)
+
+
+# Prompts are parsed once at import instead of on every node call
+ROUTER_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You are a routing assistant. Analyze the user's question and determine if it's about:
+    1. WEATHER: Questions about weather, temperature, climate, forecast for a location
+    2. PDF: Questions about document content, information retrieval from documents
+    
+    Respond with ONLY one word: 'weather' or 'pdf'"""),
+    ("human", "{question}")
+])
+
+LOCATION_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Extract ONLY the city name from the user's question. Return only the city name, nothing else."),
+    ("human", "{question}")
+])
+
+WEATHER_ANSWER_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You are a helpful weather assistant. Use the provided weather data to answer the user's question naturally and conversationally."""),
+    ("human", "Weather Data:\n{context}\n\nQuestion: {question}\n\nAnswer:")
+])
+
+PDF_ANSWER_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You are a helpful assistant. Use the provided document context to answer the user's question. 
+    If the answer is not in the context, say so. Be concise and accurate."""),
+    ("human", "Context:\n{context}\n\nQuestion: {question}\n\nAnswer:")
+])
+
+EVAL_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """Evaluate the response on a scale of 1-10 for:
+    1. Relevance: Does it answer the question?
+    2. Accuracy: Is the information correct based on context?
+    3. Completeness: Is the answer complete?"""),
+    ("human", "Question: {question}\n\nContext: {context}\n\nResponse: {generation}")
+])
+
+# Prompts whose chains end in plain text output
+TEXT_PROMPTS = {
+    "router": ROUTER_PROMPT,
+    "location": LOCATION_PROMPT,
+    "weather": WEATHER_ANSWER_PROMPT,
+    "pdf": PDF_ANSWER_PROMPT
+}
 
 
 # Define State
@@ -23,54 +114,126 @@ class GraphState(TypedDict):
     weather_data: dict
     retrieved_docs: List[str]
     rerank_scores: List[float]
+    rerank: bool
+    question_embedding: List[float]
     generation: str
     evaluation: dict
 
 
-# Initialize LLM lazily
+class EvalScores(BaseModel):
+    """Evaluation scores for a generated response (1-10 each)."""
+    relevance: int = Field(description="Does it answer the question?")
+    accuracy: int = Field(description="Is the information correct based on context?")
+    completeness: int = Field(description="Is the answer complete?")
+
+
+@lru_cache(maxsize=1)
+def get_http_client() -> httpx.AsyncClient:
+    """Get the async HTTP connection pool shared by OpenAI, Cohere and OpenWeatherMap.
+    
+    Calls reuse warm keep-alive connections (HTTP/2 multiplexed where the
+    server supports it). Closed on API shutdown by close_http_client.
+    """
+    return httpx.AsyncClient(
+        timeout=60,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+        http2=True
+    )
+
+
+async def close_http_client():
+    """Close the shared HTTP client and drop the LLM and Cohere clients built on it.
+    
+    The next call builds fresh ones, so an app started again in the same
+    process (e.g. repeated TestClient lifespans) doesn't reuse a closed pool.
+    """
+    if get_http_client.cache_info().currsize:
+        await get_http_client().aclose()
+    for factory in (get_http_client, get_llm, get_chain, get_eval_chain, get_cohere_client):
+        factory.cache_clear()
+
+
+# Initialize LLM lazily, once per process, so every node shares its connection pool
+@lru_cache(maxsize=1)
 def get_llm():
-    """Get or create LLM instance."""
+    """Get the shared LLM instance."""
     return ChatOpenAI(
         model="gpt-4o-mini",
         temperature=0,
-        openai_api_key=OPENAI_API_KEY
+        openai_api_key=OPENAI_API_KEY,
+        http_async_client=get_http_client()
     )
 
 
-def router_node(state: GraphState) -> GraphState:
-    """Route query to weather API or PDF RAG based on intent."""
-    question = state["question"]
+@lru_cache(maxsize=None)
+def get_chain(name: str):
+    """Get the prompt -> LLM -> text chain for a named prompt (composed once)."""
+    return TEXT_PROMPTS[name] | get_llm() | StrOutputParser()
+
+
+@lru_cache(maxsize=1)
+def get_eval_chain():
+    """Get the evaluation chain (prompt -> LLM with structured scores, composed once)."""
+    # Structured output returns validated scores, no JSON parsing needed
+    return EVAL_PROMPT | get_llm().with_structured_output(EvalScores)
+
+
+@lru_cache(maxsize=1)
+def get_cohere_client():
+    """Get the shared async Cohere client (created on first rerank)."""
+    return cohere.AsyncClient(api_key=COHERE_API_KEY, httpx_client=get_http_client())
+
+
+# Router decisions memoized per normalized question (lru_cache can't memoize coroutines)
+route_cache = LRUCache(maxsize=ROUTER_CACHE_MAXSIZE)
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase a question and strip punctuation and extra whitespace."""
+    return " ".join(PUNCTUATION_PATTERN.sub(" ", question.lower()).split())
+
+
+async def classify_question(question: str) -> str:
+    """Classify a question as 'weather' or 'pdf' (memoized per normalized question)."""
+    key = normalize_question(question)
+    route = route_cache.get(key)
+    if route is not None:
+        return route
     
-    router_prompt = ChatPromptTemplate.from_messages([
-        ("system", """You are a routing assistant. Analyze the user's question and determine if it's about:
-        1. WEATHER: Questions about weather, temperature, climate, forecast for a location
-        2. PDF: Questions about document content, information retrieval from documents
-        
-        Respond with ONLY one word: 'weather' or 'pdf'"""),
-        ("human", "{question}")
-    ])
+    # Obvious weather questions don't need the LLM
+    if WEATHER_KEYWORD_PATTERN.search(key):
+        route_cache[key] = "weather"
+        return "weather"
     
-    chain = router_prompt | get_llm() | StrOutputParser()
-    route = chain.invoke({"question": question}).strip().lower()
+    route = (await get_chain("router").ainvoke({"question": question})).strip().lower()
+    route_cache[key] = route
+    return route
+
+
+async def router_node(state: GraphState) -> GraphState:
+    """Route query to weather API or PDF RAG based on intent."""
+    route = await classify_question(state["question"])
     
-    print(f"🔀 Router Decision: {route}")
+    log.debug("🔀 Router Decision: %s", route)
     return {"route": route}
 
 
-def weather_node(state: GraphState) -> GraphState:
+def match_city(question: str) -> Optional[str]:
+    """Find a known city name in the question (None if there is no match)."""
+    match = CITY_PATTERN.search(question)
+    return CITY_NAMES[match.group(1).lower()] if match else None
+
+
+async def weather_node(state: GraphState) -> GraphState:
     """Fetch weather data from OpenWeatherMap API."""
     question = state["question"]
     
-    # Extract location using LLM
-    location_prompt = ChatPromptTemplate.from_messages([
-        ("system", "Extract ONLY the city name from the user's question. Return only the city name, nothing else."),
-        ("human", "{question}")
-    ])
-    
-    chain = location_prompt | get_llm() | StrOutputParser()
-    city = chain.invoke({"question": question}).strip()
+    # Extract location from the gazetteer, falling back to the LLM for unknown cities
+    city = match_city(question)
+    if city is None:
+        city = (await get_chain("location").ainvoke({"question": question})).strip()
     
-    print(f"🌍 Fetching weather for: {city}")
+    log.debug("🌍 Fetching weather for: %s", city)
     
     # Fetch weather data
     params = {
@@ -80,158 +243,171 @@ def weather_node(state: GraphState) -> GraphState:
     }
     
     try:
-        response = requests.get(OPENWEATHER_BASE_URL, params=params, timeout=10)
+        response = await get_http_client().get(OPENWEATHER_BASE_URL, params=params, timeout=10)
         response.raise_for_status()
         weather_data = response.json()
         
-        context = f"""
-        Location: {weather_data['name']}, {weather_data['sys']['country']}
-        Temperature: {weather_data['main']['temp']}°C
-        Feels Like: {weather_data['main']['feels_like']}°C
-        Humidity: {weather_data['main']['humidity']}%
-        Weather: {weather_data['weather'][0]['description']}
-        Wind Speed: {weather_data['wind']['speed']} m/s
-        """
+        main = weather_data["main"]
+        context = "\n".join((
+            f"Location: {weather_data['name']}, {weather_data['sys']['country']}",
+            f"Temperature: {main['temp']}°C",
+            f"Feels Like: {main['feels_like']}°C",
+            f"Humidity: {main['humidity']}%",
+            f"Weather: {weather_data['weather'][0]['description']}",
+            f"Wind Speed: {weather_data['wind']['speed']} m/s"
+        ))
         
         return {"weather_data": weather_data, "context": context}
     
     except Exception as e:
         error_context = f"Error fetching weather data: {str(e)}"
-        print(f"❌ {error_context}")
+        log.warning("❌ %s", error_context)
         return {"weather_data": {}, "context": error_context}
 
 
-def rag_retrieval_node(state: GraphState) -> GraphState:
+def is_literal_query(question: str) -> bool:
+    """Check if the question is a quoted phrase or a filename lookup."""
+    return LITERAL_QUERY_PATTERN.fullmatch(question.strip()) is not None
+
+
+async def rag_retrieval_node(state: GraphState) -> GraphState:
     """Retrieve relevant documents from Qdrant with manual reranking."""
     question = state["question"]
     
-    print(f"📚 Retrieving documents for: {question}")
+    log.debug("📚 Retrieving documents for: %s", question)
     
     try:
-        vectorstore = get_vector_store()
-        
-        # Step 1: Initial retrieval from Qdrant with higher k
-        retriever = vectorstore.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": RETRIEVAL_TOP_K}  # Get 10 candidates
-        )
-        
-        initial_docs = retriever.invoke(question)
-        print(f"🔍 Initial retrieval: {len(initial_docs)} candidates")
-        
-        # Step 2: Manual reranking with Cohere
-        import cohere
-        co = cohere.Client(api_key=COHERE_API_KEY)
-        
-        # Prepare documents for reranking
-        documents = [doc.page_content for doc in initial_docs]
-        
-        # Rerank with Cohere
-        rerank_response = co.rerank(
-            model="rerank-english-v3.0",
-            query=question,
-            documents=documents,
-            top_n=RERANK_TOP_N,
-            return_documents=True
-        )
-        
-        print(f"✨ Reranked to top {len(rerank_response.results)} documents")
-        
-        # Step 3: Extract reranked documents and scores
-        retrieved_texts = []
-        rerank_scores = []
-        
-        for result in rerank_response.results:
-            retrieved_texts.append(result.document.text)
-            rerank_scores.append(result.relevance_score)
-        
-        context = "\n\n".join(retrieved_texts)
-        
-        print(f"✅ Retrieved {len(retrieved_texts)} documents with scores: {[f'{s:.4f}' for s in rerank_scores]}")
-        
-        return {
-            "retrieved_docs": retrieved_texts, 
-            "context": context,
-            "rerank_scores": rerank_scores
-        }
+        # Step 1: Initial retrieval from Qdrant with higher k (batch API, one round-trip)
+        # Reuse the question embedding if the caller already computed it.
+        # The Qdrant and embedding clients are blocking, so run them in a thread.
+        question_embedding = state.get("question_embedding")
+        initial_docs = (await asyncio.to_thread(
+            search_documents_batch,
+            [question],
+            RETRIEVAL_TOP_K,  # Get 10 candidates
+            query_vectors=[question_embedding] if question_embedding else None
+        ))[0]
+        log.debug("🔍 Initial retrieval: %d candidates", len(initial_docs))
     
     except Exception as e:
         error_context = f"Error retrieving documents: {str(e)}"
-        print(f"❌ {error_context}")
+        log.warning("❌ %s", error_context)
         return {
             "retrieved_docs": [], 
             "context": error_context,
             "rerank_scores": []
         }
+    
+    # Prepare documents for reranking
+    documents = [doc.page_content for doc in initial_docs]
+    
+    # Literal lookups (quoted phrases, filenames) don't benefit from the cross-encoder
+    if not state.get("rerank", True) or is_literal_query(question):
+        log.debug("⏭️ Skipping rerank, using vector search order")
+        retrieved_texts = documents[:RERANK_TOP_N]
+        return {
+            "retrieved_docs": retrieved_texts,
+            "context": "\n\n".join(retrieved_texts),
+            "rerank_scores": []
+        }
+    
+    try:
+        # Step 2: Reuse cached scores, only send uncached chunks to Cohere
+        cached_scores = get_cached_scores(question, documents)
+        scores = {doc: score for doc, score in zip(documents, cached_scores) if score is not None}
+        uncached_docs = [doc for doc, score in zip(documents, cached_scores) if score is None]
+        log.debug("🗃️ Rerank cache: %d hits, %d misses", len(scores), len(uncached_docs))
+        
+        if uncached_docs:
+            # Score every uncached chunk so the results can be cached and merged
+            async with rerank_semaphore:
+                rerank_response = await get_cohere_client().rerank(
+                    model="rerank-english-v3.0",
+                    query=question,
+                    documents=uncached_docs,
+                    top_n=len(uncached_docs),
+                    return_documents=True
+                )
+            
+            new_scores = {result.document.text: result.relevance_score for result in rerank_response.results}
+            store_scores(question, new_scores)
+            scores.update(new_scores)
+        
+        # Step 3: Keep the top reranked documents and scores
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:RERANK_TOP_N]
+        retrieved_texts = [doc for doc, _ in ranked]
+        rerank_scores = [score for _, score in ranked]
+        
+        log.debug("✨ Reranked to top %d documents", len(retrieved_texts))
+    
+    except Exception as e:
+        # Fall back to vector search order if Cohere is unavailable
+        log.warning("⚠️ Rerank error, using vector search order: %s", e)
+        retrieved_texts = documents[:RERANK_TOP_N]
+        rerank_scores = []
+    
+    context = "\n\n".join(retrieved_texts)
+    
+    log.debug("✅ Retrieved %d documents with scores: %s", len(retrieved_texts), rerank_scores)
+    
+    return {
+        "retrieved_docs": retrieved_texts, 
+        "context": context,
+        "rerank_scores": rerank_scores
+    }
 
 
-def generation_node(state: GraphState) -> GraphState:
+async def generation_node(state: GraphState) -> GraphState:
     """Generate final response using LLM with context."""
     question = state["question"]
     context = state.get("context", "")
     route = state["route"]
     
-    if route == "weather":
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """You are a helpful weather assistant. Use the provided weather data to answer the user's question naturally and conversationally."""),
-            ("human", "Weather Data:\n{context}\n\nQuestion: {question}\n\nAnswer:")
-        ])
-    else:  # pdf
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", """You are a helpful assistant. Use the provided document context to answer the user's question. 
-            If the answer is not in the context, say so. Be concise and accurate."""),
-            ("human", "Context:\n{context}\n\nQuestion: {question}\n\nAnswer:")
-        ])
-    
-    chain = prompt | get_llm() | StrOutputParser()
-    generation = chain.invoke({"context": context, "question": question})
+    chain = get_chain("weather" if route == "weather" else "pdf")
+    generation = await chain.ainvoke({"context": context, "question": question})
     
-    print(f"✨ Generated response: {generation}")
+    log.debug("✨ Generated response: %s", generation)
     
     return {"generation": generation}
 
 
-def evaluation_node(state: GraphState) -> GraphState:
+def eval_inputs(state: GraphState) -> dict:
+    """Select the evaluation chain inputs from a graph state."""
+    return {
+        "question": state["question"],
+        "context": state.get("context", ""),
+        "generation": state["generation"]
+    }
+
+
+async def evaluation_node(state: GraphState) -> GraphState:
     """Evaluate response quality using LangSmith criteria."""
-    question = state["question"]
-    generation = state["generation"]
-    context = state.get("context", "")
-    
-    eval_prompt = ChatPromptTemplate.from_messages([
-        ("system", """Evaluate the response on a scale of 1-10 for:
-        1. Relevance: Does it answer the question?
-        2. Accuracy: Is the information correct based on context?
-        3. Completeness: Is the answer complete?
-        
-        You MUST respond with ONLY valid JSON in this exact format, no other text: 
-        {{"relevance": X, "accuracy": Y, "completeness": Z}}"""),
-        ("human", "Question: {question}\n\nContext: {context}\n\nResponse: {generation}")
-    ])
-    
-    chain = eval_prompt | get_llm() | StrOutputParser()
+    chain = get_eval_chain()
     
     try:
-        eval_result = chain.invoke({
-            "question": question,
-            "context": context,
-            "generation": generation
-        })
-
-        print(f"🧪 Evaluation result: {eval_result}")
-
-        # Clean the response (remove markdown code blocks if present)
-        eval_result = eval_result.strip()
-        if eval_result.startswith("```json"):
-            eval_result = eval_result.replace("```json", "").replace("```", "")
-        elif eval_result.startswith("```"):
-            eval_result = eval_result.replace("```", "")
+        eval_result = await chain.ainvoke(eval_inputs(state))
         
-        import json
-        evaluation = json.loads(eval_result)
-        print(f"📊 Evaluation: {evaluation}")
+        evaluation = eval_result.model_dump()
+        log.debug("📊 Evaluation: %s", evaluation)
         
         return {"evaluation": evaluation}
     
     except Exception as e:
-        print(f"⚠️ Evaluation error: {e}")
+        log.warning("⚠️ Evaluation error: %s", e)
         return {"evaluation": {"error": str(e)}}
+
+
+async def evaluate_batch(states: List[GraphState]) -> List[dict]:
+    """Evaluate several responses with one batched chain call."""
+    chain = get_eval_chain()
+    
+    # abatch runs the calls concurrently over the shared connection pool;
+    # one failed evaluation doesn't discard the others
+    eval_results = await chain.abatch([eval_inputs(state) for state in states], return_exceptions=True)
+    
+    evaluations = [
+        {"error": str(result)} if isinstance(result, Exception) else result.model_dump()
+        for result in eval_results
+    ]
+    log.debug("📊 Evaluated %d responses in one batch", len(evaluations))
+    return evaluations
@@ -0,0 +1,38 @@
+import hashlib
+import threading
+from typing import Dict, List, Optional
+from cachetools import TTLCache
+from config import RERANK_CACHE_MAXSIZE, RERANK_CACHE_TTL
+
+
+# Rerank scores keyed by (query hash, chunk hash). Cohere scores each
+# (query, document) pair independently, so cached scores can be merged
+# with fresh ones from a later call.
+_score_cache = TTLCache(maxsize=RERANK_CACHE_MAXSIZE, ttl=RERANK_CACHE_TTL)
+_lock = threading.Lock()  # Nodes run on the event loop, but TTLCache isn't thread-safe if called from a thread
+
+
+def _hash(text: str) -> str:
+    """Hash text for use in a cache key."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_cached_scores(query: str, documents: List[str]) -> List[Optional[float]]:
+    """Get cached rerank scores for each document (None if not cached)."""
+    query_hash = _hash(query)
+    with _lock:
+        return [_score_cache.get((query_hash, _hash(doc))) for doc in documents]
+
+
+def store_scores(query: str, scores: Dict[str, float]):
+    """Cache rerank scores for a query, given as a document -> score mapping."""
+    query_hash = _hash(query)
+    with _lock:
+        for doc, score in scores.items():
+            _score_cache[(query_hash, _hash(doc))] = score
+
+
+def clear_cache():
+    """Drop all cached rerank scores."""
+    with _lock:
+        _score_cache.clear()
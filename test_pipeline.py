@@ -1,7 +1,36 @@
 import pytest
-from unittest.mock import Mock, patch, MagicMock
-from nodes import router_node, weather_node, rag_retrieval_node, generation_node
+import asyncio
+import json
+import hashlib
+import fitz
+from types import SimpleNamespace
+from unittest.mock import patch, AsyncMock, MagicMock
+from nodes import router_node, weather_node, rag_retrieval_node, generation_node, evaluation_node, evaluate_batch, route_cache, EvalScores
 from graph import build_graph
+import utils
+import main
+import orjson
+from fastapi.testclient import TestClient
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from nodes import TEXT_PROMPTS
+
+
+def mock_llm_chain(output):
+    """Build a chain mock whose ainvoke returns the given output."""
+    chain = AsyncMock()
+    chain.ainvoke.return_value = output
+    return chain
+
+
+@pytest.fixture(autouse=True)
+def clear_router_cache():
+    """Start every test with an empty router decision cache."""
+    route_cache.clear()
+    yield
+    route_cache.clear()
 
 
 @pytest.fixture
@@ -30,111 +59,469 @@ def mock_pdf_state():
     }
 
 
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-def test_router_weather_intent(mock_from_messages, mock_get_llm, mock_parser, mock_weather_state):
+@patch('nodes.get_chain')
+def test_router_weather_intent(mock_get_chain, mock_weather_state):
     """Test router correctly identifies weather queries."""
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "weather"
-    
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
+    mock_get_chain.return_value = mock_llm_chain("weather")
     
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = router_node(mock_weather_state)
+    result = asyncio.run(router_node(mock_weather_state))
     assert result["route"] == "weather"
 
 
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-def test_router_pdf_intent(mock_from_messages, mock_get_llm, mock_parser, mock_pdf_state):
+@patch('nodes.get_chain')
+def test_router_pdf_intent(mock_get_chain, mock_pdf_state):
     """Test router correctly identifies PDF queries."""
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "pdf"
-    
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
+    mock_get_chain.return_value = mock_llm_chain("pdf")
     
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
+    result = asyncio.run(router_node(mock_pdf_state))
+    assert result["route"] == "pdf"
+
+
+@patch('nodes.get_chain')
+def test_router_keyword_fast_path(mock_get_chain, mock_weather_state):
+    """Test obvious weather queries are routed without calling the LLM."""
+    result = asyncio.run(router_node(mock_weather_state))
+    assert result["route"] == "weather"
+    mock_get_chain.assert_not_called()
+
+
+@patch('nodes.get_chain')
+def test_router_caches_decisions(mock_get_chain, mock_pdf_state):
+    """Test repeated questions reuse the cached routing decision."""
+    mock_chain = mock_llm_chain("pdf")
+    mock_get_chain.return_value = mock_chain
     
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
+    asyncio.run(router_node(mock_pdf_state))
+    result = asyncio.run(router_node(mock_pdf_state))
+    assert result["route"] == "pdf"
+    assert mock_chain.ainvoke.call_count == 1
+
+
+@patch('nodes.get_chain')
+def test_router_cache_normalizes_questions(mock_get_chain):
+    """Test questions differing only in case and punctuation share a routing decision."""
+    mock_chain = mock_llm_chain("pdf")
+    mock_get_chain.return_value = mock_chain
     
-    result = router_node(mock_pdf_state)
+    asyncio.run(router_node({"question": "Who is Kalam?"}))
+    result = asyncio.run(router_node({"question": "  who is KALAM  "}))
     assert result["route"] == "pdf"
+    assert mock_chain.ainvoke.call_count == 1
+
 
+def test_close_http_client_rebuilds_on_next_use():
+    """Test an app started again in the same process gets an open HTTP client, not the closed one."""
+    import nodes
+    
+    async def restart():
+        closed = nodes.get_http_client()
+        await nodes.close_http_client()
+        return closed, nodes.get_http_client()
+    
+    closed, reopened = asyncio.run(restart())
+    
+    assert closed.is_closed
+    assert reopened is not closed and not reopened.is_closed
+    asyncio.run(nodes.close_http_client())
 
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_node_success(mock_get, mock_from_messages, mock_get_llm, mock_parser, mock_weather_state):
+
+@patch('nodes.get_chain')
+@patch('nodes.get_http_client')
+def test_weather_node_success(mock_get_http_client, mock_get_chain, mock_weather_state):
     """Test weather API call with successful response."""
-    mock_response = Mock()
-    mock_response.json.return_value = {
+    payload = {
         "name": "London",
         "sys": {"country": "GB"},
         "main": {"temp": 15, "feels_like": 13, "humidity": 80},
         "weather": [{"description": "cloudy"}],
         "wind": {"speed": 5}
     }
-    mock_response.raise_for_status = Mock()
-    mock_get.return_value = mock_response
-    
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "London"
-    
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
+    mock_get = mock_get_http_client.return_value.get = AsyncMock()
+    mock_get.return_value = SimpleNamespace(json=lambda: payload, raise_for_status=lambda: None)
     
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
+    mock_get_chain.return_value = mock_llm_chain("London")
     
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = weather_node(mock_weather_state)
+    result = asyncio.run(weather_node(mock_weather_state))
     assert "weather_data" in result
     assert "London" in result["context"]
 
 
-@patch('nodes.get_vector_store')
-def test_rag_retrieval_node(mock_vectorstore, mock_pdf_state):
-    """Test RAG retrieval from Qdrant."""
-    mock_doc = Mock()
-    mock_doc.page_content = "Test document content"
+@patch('nodes.get_chain')
+@patch('nodes.get_http_client')
+def test_weather_node_known_city_skips_llm(mock_get_http_client, mock_get_chain):
+    """Test cities in the gazetteer are extracted without the location LLM call."""
+    payload = {
+        "name": "New Delhi",
+        "sys": {"country": "IN"},
+        "main": {"temp": 30, "feels_like": 33, "humidity": 40},
+        "weather": [{"description": "clear sky"}],
+        "wind": {"speed": 3}
+    }
+    mock_get = mock_get_http_client.return_value.get = AsyncMock()
+    mock_get.return_value = SimpleNamespace(json=lambda: payload, raise_for_status=lambda: None)
     
-    mock_retriever = Mock()
-    mock_retriever.invoke.return_value = [mock_doc]
+    result = asyncio.run(weather_node({"question": "Is it hot in new delhi today?"}))
+    assert "New Delhi" in result["context"]
+    assert mock_get.call_args.kwargs["params"]["q"] == "New Delhi"
+    mock_get_chain.assert_not_called()
+
+
+@patch('nodes.search_documents_batch')
+def test_rag_retrieval_node(mock_search, mock_pdf_state):
+    """Test RAG retrieval from Qdrant."""
+    mock_doc = SimpleNamespace(page_content="Test document content")
     
-    mock_vs = Mock()
-    mock_vs.as_retriever.return_value = mock_retriever
-    mock_vectorstore.return_value = mock_vs
+    mock_search.return_value = [[mock_doc]]
     
-    result = rag_retrieval_node(mock_pdf_state)
+    result = asyncio.run(rag_retrieval_node(mock_pdf_state))
     assert "retrieved_docs" in result
     assert len(result["retrieved_docs"]) > 0
     assert result["retrieved_docs"][0] == "Test document content"
 
 
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-def test_generation_node_weather(mock_from_messages, mock_get_llm, mock_parser):
+@patch('utils.get_embeddings')
+def test_embed_queries_reuses_cached_embeddings(mock_get_embeddings):
+    """Test repeated queries are only sent to the embeddings API once."""
+    utils.embedding_cache.clear()
+    mock_get_embeddings.return_value.embed_documents.side_effect = lambda texts: [[float(len(t))] for t in texts]
+    
+    first = utils.embed_queries(["Who is Kalam?"])
+    second = utils.embed_queries(["Who is Kalam? ", "What is ISRO?"])
+    
+    assert second[0] == first[0]
+    assert second[1] == [len("What is ISRO?")]
+    calls = mock_get_embeddings.return_value.embed_documents.call_args_list
+    assert [call.args[0] for call in calls] == [["Who is Kalam?"], ["What is ISRO?"]]
+    utils.embedding_cache.clear()
+
+
+@patch('utils.get_vector_store')
+@patch('utils.get_embeddings')
+def test_search_documents_batch_reuses_cached_query_embedding(mock_get_embeddings, mock_get_vector_store):
+    """Test a repeated question is searched without a second embeddings call."""
+    utils.embedding_cache.clear()
+    mock_get_embeddings.return_value.embed_documents.side_effect = lambda texts: [[1.0] for _ in texts]
+    mock_get_vector_store.return_value.vector_name = ""
+    client = mock_get_vector_store.return_value.client
+    client.query_batch_points.return_value = [SimpleNamespace(points=[])]
+    
+    utils.search_documents_batch(["Who is Kalam?"], k=5)
+    utils.search_documents_batch(["Who is Kalam?"], k=5)
+    
+    assert mock_get_embeddings.return_value.embed_documents.call_count == 1
+    assert client.query_batch_points.call_count == 2
+    utils.embedding_cache.clear()
+
+
+def test_open_pdf_reads_memory_mapped_file(tmp_path):
+    """Test PDFs opened over a memory map read normally and release the mapping on close."""
+    pdf_path = str(tmp_path / "mapped.pdf")
+    with fitz.open() as doc:
+        doc.new_page().insert_text((72, 72), "Mapped page")
+        doc.save(pdf_path)
+    
+    for _ in range(2):
+        with utils.open_pdf(pdf_path) as doc:
+            assert doc.page_count == 1
+            assert "Mapped page" in doc[0].get_text()
+
+
+def test_split_pdf_parallel_matches_sequential(tmp_path, monkeypatch):
+    """Test page ranges split in worker processes keep page order."""
+    # Character-count splitter, so the test doesn't download the tiktoken encoding
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=400, chunk_overlap=50)
+    
+    pdf_path = str(tmp_path / "pages.pdf")
+    with fitz.open() as doc:
+        for i in range(5):
+            doc.new_page().insert_text((72, 72), f"Page {i} text")
+        doc.save(pdf_path)
+    
+    sequential = utils.split_pdf(pdf_path, num_workers=1, text_splitter=text_splitter)
+    monkeypatch.setattr(utils, "PDF_MIN_PAGES_PER_WORKER", 1)
+    parallel = utils.split_pdf(pdf_path, num_workers=2, text_splitter=text_splitter)
+    
+    assert parallel == sequential
+    assert [chunk.strip() for chunk in sequential] == [f"Page {i} text" for i in range(5)]
+
+
+@patch('openai.OpenAI')
+def test_embed_texts_batch_api_matches_results_by_custom_id(mock_openai, monkeypatch):
+    """Test Batch API output lines are mapped back to chunks whatever order they come in."""
+    monkeypatch.setattr(utils, "EMBEDDING_BATCH_SIZE", 2)
+    client = mock_openai.return_value
+    client.batches.create.return_value = SimpleNamespace(id="batch_1", status="in_progress")
+    client.batches.retrieve.return_value = SimpleNamespace(
+        id="batch_1", status="completed", output_file_id="file_out", request_counts=SimpleNamespace(failed=0)
+    )
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: None)
+    output = [
+        {"custom_id": "2", "response": {"body": {"data": [{"index": 0, "embedding": [3.0]}]}}},
+        {"custom_id": "0", "response": {"body": {"data": [{"index": 1, "embedding": [2.0]}, {"index": 0, "embedding": [1.0]}]}}}
+    ]
+    client.files.content.return_value = SimpleNamespace(text="\n".join(json.dumps(line) for line in output))
+    
+    monkeypatch.setattr(utils, "EMBEDDING_DIM", 1)
+    
+    vectors = utils.embed_texts_batch_api(["a", "b", "c", "a"])
+    
+    assert vectors.dtype == "float32"
+    assert vectors.tolist() == [[1.0], [2.0], [3.0], [1.0]]
+    assert client.batches.create.call_args.kwargs["endpoint"] == "/v1/embeddings"
+
+
+def uploaded_points(client):
+    """Collect the points from every upsert call on a mocked Qdrant client."""
+    return [point for call in client.upsert.call_args_list for point in call.kwargs["points"]]
+
+
+@patch('utils.AsyncQdrantClient')
+def test_ingest_chunks_uploads_each_embedded_batch(mock_client_cls, monkeypatch):
+    """Test chunks are embedded and upserted in fixed-size batches with matching vectors."""
+    monkeypatch.setattr(utils, "EMBEDDING_BATCH_SIZE", 2)
+    monkeypatch.setattr(utils, "QDRANT_UPLOAD_BATCH_SIZE", 2)
+    client = mock_client_cls.return_value = AsyncMock()
+    calls = []
+    embeddings = SimpleNamespace(embed_documents=lambda texts: calls.append(texts) or [[float(t)] for t in texts])
+    
+    utils.ingest_chunks([str(i) for i in range(5)], embeddings, "abc")
+    
+    assert sorted(calls) == [["0", "1"], ["2", "3"], ["4"]]
+    points = uploaded_points(client)
+    assert sorted((point.payload["page_content"], point.vector) for point in points) == [
+        (str(i), [float(i)]) for i in range(5)
+    ]
+    assert all(point.payload["metadata"] == {"doc_hash": "abc"} for point in points)
+    client.close.assert_awaited_once()
+
+
+@patch('utils.AsyncQdrantClient')
+def test_ingest_chunks_embeds_duplicate_chunks_once(mock_client_cls):
+    """Test identical chunks share one embedding but are each stored."""
+    client = mock_client_cls.return_value = AsyncMock()
+    calls = []
+    embeddings = SimpleNamespace(embed_documents=lambda texts: calls.append(texts) or [[float(len(t))] for t in texts])
+    
+    utils.ingest_chunks(["footer", "body text", "footer"], embeddings, "abc")
+    
+    assert calls == [["footer", "body text"]]
+    assert sorted((point.payload["page_content"], point.vector) for point in uploaded_points(client)) == [
+        ("body text", [9.0]), ("footer", [6.0]), ("footer", [6.0])
+    ]
+
+
+@patch('utils.AsyncQdrantClient')
+def test_ingest_chunks_bounds_batches_waiting_to_upload(mock_client_cls, monkeypatch):
+    """Test a new batch isn't embedded while the allowed number of batches still await upload."""
+    monkeypatch.setattr(utils, "EMBEDDING_BATCH_SIZE", 1)
+    monkeypatch.setattr(utils, "INGEST_MAX_BATCHES_IN_FLIGHT", 2)
+    in_flight = []
+    peak = []
+    
+    def embed_documents(texts):
+        in_flight.append(texts)
+        peak.append(len(in_flight))
+        return [[1.0] for _ in texts]
+    
+    async def slow_upsert(collection_name, points):
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+    
+    client = mock_client_cls.return_value = AsyncMock()
+    client.upsert.side_effect = slow_upsert
+    
+    utils.ingest_chunks([str(i) for i in range(6)], SimpleNamespace(embed_documents=embed_documents), "abc")
+    
+    assert max(peak) <= 2
+    assert len(uploaded_points(client)) == 6
+
+
+@patch('utils.AsyncQdrantClient')
+def test_ingest_chunks_same_pdf_reuses_point_ids(mock_client_cls):
+    """Test ingesting the same PDF twice writes the same point ids, so racing workers can't duplicate chunks."""
+    client = mock_client_cls.return_value = AsyncMock()
+    embeddings = SimpleNamespace(embed_documents=lambda texts: [[1.0] for _ in texts])
+    
+    utils.ingest_chunks(["footer", "body text", "footer"], embeddings, "abc")
+    first = sorted(point.id for point in uploaded_points(client))
+    client.upsert.reset_mock()
+    utils.ingest_chunks(["footer", "body text", "footer"], embeddings, "abc")
+    
+    assert sorted(point.id for point in uploaded_points(client)) == first
+    assert len(set(first)) == 3
+
+
+@pytest.fixture
+def ingest_mocks(monkeypatch):
+    """Patch create_vector_store's Qdrant client and ingestion steps."""
+    mocks = SimpleNamespace(client=MagicMock(), ingest_chunks=MagicMock())
+    mocks.client.count.return_value = SimpleNamespace(count=0)
+    monkeypatch.setattr(utils, "get_qdrant_client", lambda: mocks.client)
+    monkeypatch.setattr(utils, "get_embeddings", MagicMock)
+    monkeypatch.setattr(utils, "get_vector_store", MagicMock)
+    monkeypatch.setattr(utils, "QdrantVectorStore", MagicMock())
+    monkeypatch.setattr(utils, "split_pdf", lambda pdf_path: ["chunk"])
+    monkeypatch.setattr(utils, "pdf_hash", lambda pdf_path: "abc")
+    monkeypatch.setattr(utils, "ingest_chunks", mocks.ingest_chunks)
+    return mocks
+
+
+def indexing_thresholds(client):
+    """Indexing thresholds set through update_collection, in call order."""
+    return [call.kwargs["optimizer_config"].indexing_threshold for call in client.update_collection.call_args_list]
+
+
+def test_create_vector_store_new_collection_restores_indexing(ingest_mocks):
+    """Test a new collection is created with indexing off, filled, then indexed."""
+    ingest_mocks.client.collection_exists.return_value = False
+    
+    utils.create_vector_store("doc.pdf")
+    
+    create_kwargs = ingest_mocks.client.create_collection.call_args.kwargs
+    assert create_kwargs["optimizers_config"].indexing_threshold == 0
+    ingest_mocks.ingest_chunks.assert_called_once()
+    assert indexing_thresholds(ingest_mocks.client) == [utils.QDRANT_INDEXING_THRESHOLD]
+
+
+def collection_info(points_count, indexing_threshold=utils.QDRANT_INDEXING_THRESHOLD, payload_schema=None):
+    """A get_collection response with the given point count, indexing threshold and payload indexes."""
+    return SimpleNamespace(
+        points_count=points_count,
+        config=SimpleNamespace(optimizer_config=SimpleNamespace(indexing_threshold=indexing_threshold)),
+        payload_schema={utils.DOC_HASH_KEY: "keyword"} if payload_schema is None else payload_schema
+    )
+
+
+def test_create_vector_store_empty_collection_ingests_and_restores_indexing(ingest_mocks):
+    """Test an existing empty collection is filled without being recreated, with indexing off meanwhile."""
+    ingest_mocks.client.collection_exists.return_value = True
+    ingest_mocks.client.get_collection.return_value = collection_info(0)
+    
+    utils.create_vector_store("doc.pdf")
+    
+    ingest_mocks.client.create_collection.assert_not_called()
+    ingest_mocks.ingest_chunks.assert_called_once()
+    assert indexing_thresholds(ingest_mocks.client) == [0, utils.QDRANT_INDEXING_THRESHOLD]
+
+
+def test_create_vector_store_populated_collection_leaves_indexing_alone(ingest_mocks):
+    """Test a populated, indexed collection skips ingestion without updating the collection."""
+    ingest_mocks.client.collection_exists.return_value = True
+    ingest_mocks.client.get_collection.return_value = collection_info(12)
+    ingest_mocks.client.count.return_value = SimpleNamespace(count=12)
+    
+    utils.create_vector_store("doc.pdf")
+    
+    ingest_mocks.ingest_chunks.assert_not_called()
+    ingest_mocks.client.update_collection.assert_not_called()
+
+
+def test_create_vector_store_populated_collection_restores_crashed_ingest_indexing(ingest_mocks):
+    """Test a populated collection left with indexing off by a crashed ingest gets it re-enabled."""
+    ingest_mocks.client.collection_exists.return_value = True
+    ingest_mocks.client.get_collection.return_value = collection_info(12, indexing_threshold=0)
+    ingest_mocks.client.count.return_value = SimpleNamespace(count=12)
+    
+    utils.create_vector_store("doc.pdf")
+    
+    ingest_mocks.ingest_chunks.assert_not_called()
+    assert indexing_thresholds(ingest_mocks.client) == [utils.QDRANT_INDEXING_THRESHOLD]
+
+
+def test_create_vector_store_populated_with_other_pdf_ingests_with_indexing_on(ingest_mocks):
+    """Test a collection holding other PDFs still gets this one, without turning its indexing off."""
+    ingest_mocks.client.collection_exists.return_value = True
+    ingest_mocks.client.get_collection.return_value = collection_info(12)
+    
+    utils.create_vector_store("doc.pdf")
+    
+    doc_filter = ingest_mocks.client.count.call_args.kwargs["count_filter"]
+    assert doc_filter.must[0].match.value == "abc"
+    ingest_mocks.ingest_chunks.assert_called_once()
+    ingest_mocks.client.update_collection.assert_not_called()
+
+
+def test_create_vector_store_adds_missing_doc_hash_index(ingest_mocks):
+    """Test an existing collection from an older build gets the doc-hash index is_ingested relies on."""
+    ingest_mocks.client.collection_exists.return_value = True
+    ingest_mocks.client.get_collection.return_value = collection_info(12, payload_schema={})
+    ingest_mocks.client.count.return_value = SimpleNamespace(count=12)
+    
+    utils.create_vector_store("doc.pdf")
+    
+    assert ingest_mocks.client.create_payload_index.call_args.kwargs["field_name"] == utils.DOC_HASH_KEY
+
+
+def test_create_vector_store_lost_create_race_leaves_indexing_alone(ingest_mocks):
+    """Test a process that didn't create the collection doesn't re-enable indexing mid-upload."""
+    ingest_mocks.client.collection_exists.side_effect = [False, True]
+    ingest_mocks.client.create_collection.side_effect = RuntimeError("already exists")
+    
+    utils.create_vector_store("doc.pdf")
+    
+    ingest_mocks.ingest_chunks.assert_called_once()
+    ingest_mocks.client.update_collection.assert_not_called()
+
+
+def test_create_vector_store_failed_ingest_restores_indexing(ingest_mocks):
+    """Test indexing is re-enabled even when the bulk upload fails."""
+    ingest_mocks.client.collection_exists.return_value = False
+    ingest_mocks.ingest_chunks.side_effect = RuntimeError("upload failed")
+    
+    with pytest.raises(RuntimeError):
+        utils.create_vector_store("doc.pdf")
+    
+    assert indexing_thresholds(ingest_mocks.client) == [utils.QDRANT_INDEXING_THRESHOLD]
+
+
+def test_gunicorn_master_ingests_once_then_closes_clients(tmp_path, monkeypatch):
+    """Test the gunicorn on_starting hook ingests the PDF and leaves no clients for workers to inherit."""
+    import config
+    import gunicorn_conf
+    pdf_path = tmp_path / "doc.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4")
+    monkeypatch.setattr(config, "PDF_PATH", str(pdf_path))
+    create_vector_store = MagicMock(side_effect=RuntimeError("Qdrant unreachable"))
+    reset_clients = MagicMock()
+    monkeypatch.setattr(utils, "create_vector_store", create_vector_store)
+    monkeypatch.setattr(utils, "reset_clients", reset_clients)
+    server = MagicMock()
+    
+    gunicorn_conf.on_starting(server)
+    
+    create_vector_store.assert_called_once_with(str(pdf_path))
+    reset_clients.assert_called_once()
+    server.log.error.assert_called_once()
+
+
+@patch('utils.split_pdf')
+@patch('utils.get_vector_store')
+def test_add_documents_skips_already_ingested_pdf(mock_get_vector_store, mock_split_pdf, tmp_path):
+    """Test a PDF whose content hash is already stored is not split or re-embedded."""
+    pdf_path = tmp_path / "doc.pdf"
+    pdf_path.write_bytes(b"%PDF-1.4 same bytes")
+    client = mock_get_vector_store.return_value.client
+    client.count.return_value = SimpleNamespace(count=12)
+    
+    utils.add_documents_to_store(str(pdf_path))
+    
+    doc_filter = client.count.call_args.kwargs["count_filter"]
+    assert doc_filter.must[0].key == "metadata.doc_hash"
+    assert doc_filter.must[0].match.value == utils.pdf_hash(str(pdf_path))
+    mock_split_pdf.assert_not_called()
+
+
+def test_pdf_hash_reads_file_in_blocks(tmp_path):
+    """Test hashing a PDF larger than one read block matches hashing its whole contents."""
+    pdf_path = tmp_path / "big.pdf"
+    data = bytes(range(256)) * 5000
+    pdf_path.write_bytes(data)
+    
+    assert utils.pdf_hash(str(pdf_path)) == hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+@patch('nodes.get_chain')
+def test_generation_node_weather(mock_get_chain):
     """Test generation node for weather route."""
     state = {
         "question": "What's the weather?",
@@ -146,29 +533,16 @@ def test_generation_node_weather(mock_from_messages, mock_get_llm, mock_parser):
         "evaluation": {}
     }
     
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "The weather is 15°C"
-    
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
+    mock_get_chain.return_value = mock_llm_chain("The weather is 15°C")
     
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = generation_node(state)
+    result = asyncio.run(generation_node(state))
     assert "generation" in result
     assert result["generation"] == "The weather is 15°C"
+    mock_get_chain.assert_called_once_with("weather")
 
 
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-def test_generation_node_pdf(mock_from_messages, mock_get_llm, mock_parser):
+@patch('nodes.get_chain')
+def test_generation_node_pdf(mock_get_chain):
     """Test generation node for PDF route."""
     state = {
         "question": "What is the main topic?",
@@ -180,23 +554,54 @@ def test_generation_node_pdf(mock_from_messages, mock_get_llm, mock_parser):
         "evaluation": {}
     }
     
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "The main topic is AI"
+    mock_get_chain.return_value = mock_llm_chain("The main topic is AI")
+    
+    result = asyncio.run(generation_node(state))
+    assert "generation" in result
+    assert "AI" in result["generation"]
+    mock_get_chain.assert_called_once_with("pdf")
+
+
+@patch('nodes.get_eval_chain')
+def test_evaluation_node_structured_output(mock_get_eval_chain):
+    """Test evaluation scores come straight from the structured LLM output."""
+    state = {
+        "question": "What is the main topic?",
+        "route": "pdf",
+        "context": "This document discusses AI",
+        "weather_data": {},
+        "retrieved_docs": ["AI content"],
+        "generation": "The main topic is AI",
+        "evaluation": {}
+    }
+    
+    mock_get_eval_chain.return_value = mock_llm_chain(EvalScores(relevance=9, accuracy=8, completeness=7))
     
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
+    result = asyncio.run(evaluation_node(state))
+    assert result["evaluation"] == {"relevance": 9, "accuracy": 8, "completeness": 7}
+
+
+@patch('nodes.get_eval_chain')
+def test_evaluate_batch_keeps_partial_results(mock_get_eval_chain):
+    """Test batched evaluation returns scores per response and isolates failures."""
+    states = [
+        {"question": f"Question {i}", "context": "Context", "generation": f"Answer {i}"}
+        for i in range(2)
+    ]
     
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
+    mock_chain = AsyncMock()
+    mock_chain.abatch.return_value = [
+        EvalScores(relevance=9, accuracy=8, completeness=7),
+        Exception("rate limited")
+    ]
     
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
+    mock_get_eval_chain.return_value = mock_chain
     
-    result = generation_node(state)
-    assert "generation" in result
-    assert "AI" in result["generation"]
+    evaluations = asyncio.run(evaluate_batch(states))
+    assert mock_chain.abatch.call_count == 1
+    assert len(mock_chain.abatch.call_args.args[0]) == 2
+    assert evaluations[0] == {"relevance": 9, "accuracy": 8, "completeness": 7}
+    assert evaluations[1] == {"error": "rate limited"}
 
 
 def test_graph_structure():
@@ -206,6 +611,15 @@ def test_graph_structure():
     assert callable(app.invoke)
 
 
+def test_graph_structure_without_evaluation():
+    """Test the answer-only graph ends at generation."""
+    app = build_graph(with_evaluation=False)
+    nodes = app.get_graph().nodes
+    assert "generation" in nodes
+    assert "evaluation" not in nodes
+    assert "evaluation" in build_graph().get_graph().nodes
+
+
 def test_graph_state_schema():
     """Test GraphState TypedDict structure."""
     from nodes import GraphState
@@ -229,5 +643,169 @@ def test_graph_state_schema():
     assert "evaluation" in test_state
 
 
+
+# ============================================================================
+# API ANSWER CACHE
+# ============================================================================
+
+@pytest.fixture
+def answer_cache(monkeypatch):
+    """Give the API an empty local answer cache and a mocked Redis client."""
+    main.graph_cache.clear()
+    redis = AsyncMock()
+    redis.get.return_value = None
+    monkeypatch.setattr(main, "redis_client", redis)
+    yield redis
+    main.graph_cache.clear()
+
+
+def graph_result(answer: str = "Kalam was born in 1931.") -> dict:
+    """Build a final graph state for a PDF question."""
+    return {
+        "question": "When was Kalam born?",
+        "route": "pdf",
+        "context": "Born in 1931",
+        "retrieved_docs": ["Born in 1931"],
+        "rerank_scores": [0.9],
+        "generation": answer,
+        "evaluation": {},
+        "question_embedding": [0.1] * 8
+    }
+
+
+def test_store_result_drops_question_embedding(answer_cache):
+    """Test cached answers, local and in Redis, leave out the question embedding."""
+    key = (main.question_cache_key("When was Kalam born?"), True)
+    
+    asyncio.run(main.store_result(key, graph_result()))
+    
+    assert "question_embedding" not in main.graph_cache[key]
+    stored = orjson.loads(answer_cache.set.call_args.args[1])
+    assert "question_embedding" not in stored
+    assert stored["generation"] == "Kalam was born in 1931."
+
+
+def test_get_cached_result_falls_back_to_redis(answer_cache):
+    """Test a local miss is served from Redis and copied into the local cache."""
+    key = (main.question_cache_key("When was Kalam born?"), True)
+    answer_cache.get.return_value = orjson.dumps({"generation": "From Redis"})
+    
+    result = asyncio.run(main.get_cached_result(key))
+    
+    assert result == {"generation": "From Redis"}
+    assert main.graph_cache[key] == result
+    answer_cache.get.assert_awaited_once_with(main.redis_cache_key(key))
+
+
+def test_get_cached_result_treats_redis_errors_as_miss(answer_cache):
+    """Test an unreachable Redis is a cache miss, not a failed request."""
+    answer_cache.get.side_effect = ConnectionError("redis down")
+    
+    assert asyncio.run(main.get_cached_result(("abc", True))) is None
+
+
+@patch('main.evaluation_node', new_callable=AsyncMock)
+def test_evaluate_result_writes_scores_back_to_redis(mock_evaluation_node, answer_cache):
+    """Test background evaluation scores reach Redis, so other workers serve them."""
+    key = (main.question_cache_key("When was Kalam born?"), True)
+    mock_evaluation_node.return_value = {"evaluation": {"relevance": 9}}
+    
+    asyncio.run(main.evaluate_result(graph_result(), key))
+    
+    stored = orjson.loads(answer_cache.set.call_args.args[1])
+    assert stored["evaluation"] == {"relevance": 9}
+
+
+@patch('main.evaluation_node', new_callable=AsyncMock)
+def test_evaluate_result_failure_is_not_cached(mock_evaluation_node, answer_cache):
+    """Test a failed evaluation isn't cached, so the next request retries it."""
+    key = (main.question_cache_key("When was Kalam born?"), True)
+    asyncio.run(main.store_result(key, graph_result()))
+    answer_cache.set.reset_mock()
+    mock_evaluation_node.return_value = {"evaluation": {"error": "rate limited"}}
+    
+    asyncio.run(main.evaluate_result(graph_result(), key))
+    
+    answer_cache.set.assert_not_called()
+    assert not main.graph_cache[key]["evaluation"]
+
+
+@patch('main.evaluation_node', new_callable=AsyncMock)
+@patch('main.answer_graph_app')
+def test_query_cache_bypass_header_reruns_graph(mock_graph, mock_evaluation_node, answer_cache):
+    """Test X-Cache-Bypass skips the cached answer and runs the graph again."""
+    mock_graph.ainvoke = AsyncMock(side_effect=[graph_result("First"), graph_result("Second")])
+    mock_evaluation_node.return_value = {"evaluation": {}}
+    client = TestClient(main.app)
+    question = {"question": "When was Kalam born?"}
+    
+    first = client.post("/query", json=question).json()
+    cached = client.post("/query", json=question).json()
+    bypassed = client.post("/query", json=question, headers={"X-Cache-Bypass": "true"}).json()
+    
+    assert [first["answer"], cached["answer"], bypassed["answer"]] == ["First", "First", "Second"]
+    assert mock_graph.ainvoke.call_count == 2
+
+
+@patch('main.embed_queries')
+@patch('main.answer_graph_app')
+def test_batch_query_serves_redis_hits_as_cached(mock_graph, mock_embed_queries, answer_cache):
+    """Test batch questions answered in Redis are neither re-embedded nor re-run."""
+    answer_cache.get.return_value = orjson.dumps(graph_result("From Redis"))
+    mock_graph.ainvoke = AsyncMock()
+    
+    response = TestClient(main.app).post("/query/batch", json={"questions": ["When was Kalam born?"]})
+    
+    assert response.json()["results"][0]["answer"] == "From Redis"
+    mock_embed_queries.assert_not_called()
+    mock_graph.ainvoke.assert_not_called()
+
+
+@patch('main.run_in_background', side_effect=lambda coro: coro.close())
+@patch('main.evaluate_results', new_callable=AsyncMock)
+@patch('main.embed_queries')
+@patch('main.answer_graph_app')
+def test_batch_query_runs_repeated_question_once(mock_graph, mock_embed_queries, mock_evaluate_results, mock_run_in_background, answer_cache):
+    """Test a question repeated in a batch is embedded, answered and evaluated once."""
+    mock_graph.ainvoke = AsyncMock(return_value=graph_result())
+    mock_embed_queries.return_value = [[0.1] * 8]
+    questions = ["When was Kalam born?", "when was  Kalam born?"]
+    
+    response = TestClient(main.app).post("/query/batch", json={"questions": questions})
+    
+    assert [r["question"] for r in response.json()["results"]] == questions
+    assert [r["answer"] for r in response.json()["results"]] == ["Kalam was born in 1931."] * 2
+    mock_embed_queries.assert_called_once_with(["When was Kalam born?"])
+    mock_graph.ainvoke.assert_awaited_once()
+    fresh_results, fresh_keys = mock_evaluate_results.call_args.args
+    assert fresh_keys == [(main.question_cache_key("When was Kalam born?"), True)]
+
+
+@patch('main.evaluation_node', new_callable=AsyncMock)
+@patch('nodes.search_documents_batch')
+@patch('nodes.get_chain')
+def test_query_stream_tokens_then_full_result(mock_get_chain, mock_search, mock_evaluation_node, answer_cache, monkeypatch):
+    """Test /query/stream sends generation tokens, the /query-shaped result, then evaluation scores."""
+    monkeypatch.setenv("LANGCHAIN_TRACING_V2", "false")  # Don't send the fake runs to LangSmith
+    replies = {"router": "pdf", "pdf": "Kalam was born in 1931."}
+    mock_get_chain.side_effect = lambda name: (
+        TEXT_PROMPTS[name] | GenericFakeChatModel(messages=iter([AIMessage(replies[name])])) | StrOutputParser()
+    )
+    mock_search.return_value = [[SimpleNamespace(page_content="Born in 1931 in Rameswaram.")]]
+    mock_evaluation_node.return_value = {"evaluation": {"relevance": 9}}
+    
+    response = TestClient(main.app).post("/query/stream", json={"question": "When was Kalam born?", "rerank": False})
+    events = [json.loads(line) for line in response.text.splitlines()]
+    
+    tokens = [event["content"] for event in events if event["type"] == "token"]
+    assert len(tokens) > 1
+    assert "".join(tokens) == "Kalam was born in 1931."
+    result = next(event["data"] for event in events if event["type"] == "result")
+    assert result["answer"] == "Kalam was born in 1931."
+    assert result["route"] == "pdf"
+    assert "weather_data" not in result
+    assert events[-1] == {"type": "evaluation", "data": {"relevance": 9}}
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
@@ -1,5 +1,7 @@
 import pytest
-from unittest.mock import Mock, patch, MagicMock
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch, AsyncMock
 from nodes import (
     router_node, 
     weather_node, 
@@ -9,6 +11,9 @@ from nodes import (
     GraphState
 )
 from graph import build_graph
+from config import RERANK_TOP_N
+import rerank_cache
+import nodes
 import os
 
 
@@ -16,7 +21,31 @@ import os
 # FIXTURES
 # ============================================================================
 
-@pytest.fixture
+# Initial graph states shared by the tests (nodes return new dicts, never mutate these)
+RAG_STATE = {
+    "question": "",
+    "route": "pdf",
+    "context": "",
+    "weather_data": {},
+    "retrieved_docs": [],
+    "rerank_scores": [],
+    "generation": "",
+    "evaluation": {}
+}
+WEATHER_STATE = {**RAG_STATE, "route": "weather"}
+
+
+@pytest.fixture(autouse=True)
+def clear_rerank_cache():
+    """Start every test with an empty rerank score cache and a fresh Cohere client."""
+    rerank_cache.clear_cache()
+    nodes.get_cohere_client.cache_clear()
+    yield
+    rerank_cache.clear_cache()
+    nodes.get_cohere_client.cache_clear()
+
+
+@pytest.fixture(scope="module")
 def mock_kalam_documents():
     """Mock documents about APJ Abdul Kalam."""
     return [
@@ -33,812 +62,350 @@ def mock_kalam_documents():
     ]
 
 
+@pytest.fixture(scope="module")
+def vector_order_docs(mock_kalam_documents):
+    """Top documents in vector search order (what the node returns without reranking)."""
+    return mock_kalam_documents[:RERANK_TOP_N]
+
+
+@pytest.fixture(scope="module")
+def kalam_search_results(mock_kalam_documents):
+    """Qdrant batch search results for one query, built once per module."""
+    return [[SimpleNamespace(page_content=doc) for doc in mock_kalam_documents]]
+
+
+@pytest.fixture
+def mock_weather_api(monkeypatch):
+    """Patch the location chain and the OpenWeatherMap GET in one place.
+    
+    Tests set the return values on the `chain` and `get` mocks it returns.
+    """
+    mocks = SimpleNamespace(chain=AsyncMock(), get=AsyncMock())
+    monkeypatch.setattr(nodes, "get_chain", lambda name: mocks.chain)
+    monkeypatch.setattr(nodes, "get_http_client", lambda: SimpleNamespace(get=mocks.get))
+    return mocks
+
+
 # ============================================================================
 # 10 RAG TESTS FOR APJ ABDUL KALAM BIOGRAPHY
 # ============================================================================
 
-@patch('cohere.Client')  # 👈 Patch at cohere module level, not nodes.cohere
-@patch('nodes.get_vector_store')
-def test_rag_01_basic_kalam_query(mock_vectorstore, mock_cohere, mock_kalam_documents):
-    """Test 1: Basic RAG retrieval for APJ Kalam biography."""
-    state = {
-        "question": "Who was APJ Abdul Kalam?",
-        "route": "pdf",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
+def top_scores(start: float, step: float, count: int = 4):
+    """Rerank (document index, score) pairs for the first documents, in decreasing order."""
+    return [(i, start - i * step) for i in range(count)]
+
+
+def assert_rag_result(result, expected_len=RERANK_TOP_N, contains_any=(), contains_all=(), min_top_score=None):
+    """Check a reranked RAG result.
+    
+    Always checks the document and score counts, and that scores are in
+    (0, 1] and descending. Substring checks on the context ignore case.
+    """
+    scores = result["rerank_scores"]
+    assert len(result["retrieved_docs"]) == expected_len
+    assert len(scores) == expected_len
+    assert scores == sorted(scores, reverse=True)
+    assert all(0 < score <= 1 for score in scores)
+    
+    context = result["context"].lower()
+    if contains_any:
+        assert any(substring.lower() in context for substring in contains_any)
+    for substring in contains_all:
+        assert substring.lower() in context
+    if min_top_score is not None:
+        assert scores[0] > min_top_score
+
+
+# (question, Cohere ranking as (document index, score) pairs, assert_rag_result checks)
+RAG_CASES = [
+    pytest.param(
+        "Who was APJ Abdul Kalam?",
+        top_scores(0.95, 0.05),
+        {"contains_all": ("Kalam",)},
+        id="01_basic_kalam_query"
+    ),
+    pytest.param(
+        "Why is Kalam called the Missile Man of India?",
+        [(2, 0.98), (4, 0.94), (9, 0.91), (0, 0.87)],
+        {"contains_all": ("missile",)},
+        id="02_missile_man_query"
+    ),
+    pytest.param(
+        "When did APJ Abdul Kalam serve as President?",
+        top_scores(0.9, 0.05),
+        {"contains_any": ("2002", "President")},
+        id="03_president_query"
+    ),
+    pytest.param(
+        "What books did Dr. Kalam write?",
+        [(5, 0.96), (0, 0.88), (1, 0.85), (7, 0.82)],
+        {"contains_any": ("Wings of Fire", "books")},
+        id="04_books_query"
+    ),
+    pytest.param(
+        "When did Kalam receive the Bharat Ratna?",
+        top_scores(0.93, 0.04),
+        {"min_top_score": 0.8},
+        id="05_bharat_ratna_query"
+    ),
+    pytest.param(
+        "Where was APJ Abdul Kalam born?",
+        top_scores(0.97, 0.03),
+        {"contains_any": ("Rameswaram", "Tamil Nadu")},
+        id="06_birthplace_query"
+    ),
+    pytest.param(
+        "When and how did Dr. Kalam pass away?",
+        # Document with death information ranked first
+        [(6, 0.98), (1, 0.88), (0, 0.85), (7, 0.82)],
+        {"contains_all": ("2015",)},
+        id="07_death_query"
+    ),
+    pytest.param(
+        "What was Kalam's contribution to ISRO and DRDO?",
+        top_scores(0.95, 0.04),
+        {},
+        id="08_isro_drdo_query"
+    ),
+    pytest.param(
+        "Tell me about APJ Abdul Kalam",
+        top_scores(0.99, 0.02),
+        {},
+        id="09_rerank_scores_validation"
+    ),
+]
+
+
+@pytest.mark.parametrize("question,ranking,checks", RAG_CASES)
+@patch('cohere.AsyncClient')  # 👈 Patch at cohere module level, not nodes.cohere
+@patch('nodes.search_documents_batch')
+def test_rag_query(mock_search, mock_cohere, question, ranking, checks, mock_kalam_documents, kalam_search_results):
+    """Tests 1-9: RAG retrieval and Cohere reranking for Kalam biography questions."""
+    state = {**RAG_STATE, "question": question}
     
     # Mock Qdrant retrieval
-    mock_docs = [Mock(page_content=doc) for doc in mock_kalam_documents]
-    mock_retriever = Mock()
-    mock_retriever.invoke.return_value = mock_docs
-    mock_vs = Mock()
-    mock_vs.as_retriever.return_value = mock_retriever
-    mock_vectorstore.return_value = mock_vs
+    mock_search.return_value = kalam_search_results
     
     # Mock Cohere reranking
-    mock_cohere_client = Mock()
-    mock_results = []
-    for i, doc in enumerate(mock_kalam_documents[:4]):
-        result = Mock()
-        result.document = Mock(text=doc)
-        result.relevance_score = 0.95 - (i * 0.05)
-        mock_results.append(result)
-    
-    mock_rerank_response = Mock(results=mock_results)
-    mock_cohere_client.rerank.return_value = mock_rerank_response
-    mock_cohere.return_value = mock_cohere_client
-    
-    result = rag_retrieval_node(state)
-    
-    assert len(result["retrieved_docs"]) == 4
-    assert len(result["rerank_scores"]) == 4
-    assert "Kalam" in result["context"]
-
-
-@patch('cohere.Client')
-@patch('nodes.get_vector_store')
-def test_rag_02_missile_man_query(mock_vectorstore, mock_cohere, mock_kalam_documents):
-    """Test 2: Query about Kalam as Missile Man."""
-    state = {
-        "question": "Why is Kalam called the Missile Man of India?",
-        "route": "pdf",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_docs = [Mock(page_content=doc) for doc in mock_kalam_documents]
-    mock_retriever = Mock()
-    mock_retriever.invoke.return_value = mock_docs
-    mock_vs = Mock()
-    mock_vs.as_retriever.return_value = mock_retriever
-    mock_vectorstore.return_value = mock_vs
-    
-    mock_cohere_client = Mock()
-    mock_results = [Mock(document=Mock(text=mock_kalam_documents[2]), relevance_score=0.98),
-                   Mock(document=Mock(text=mock_kalam_documents[4]), relevance_score=0.94),
-                   Mock(document=Mock(text=mock_kalam_documents[9]), relevance_score=0.91),
-                   Mock(document=Mock(text=mock_kalam_documents[0]), relevance_score=0.87)]
-    mock_rerank_response = Mock(results=mock_results)
-    mock_cohere_client.rerank.return_value = mock_rerank_response
+    mock_cohere_client = AsyncMock()
+    mock_results = [
+        SimpleNamespace(document=SimpleNamespace(text=mock_kalam_documents[i]), relevance_score=score)
+        for i, score in ranking
+    ]
+    mock_cohere_client.rerank.return_value = SimpleNamespace(results=mock_results)
     mock_cohere.return_value = mock_cohere_client
     
-    result = rag_retrieval_node(state)
+    result = asyncio.run(rag_retrieval_node(state))
     
-    assert len(result["retrieved_docs"]) == 4
-    assert "missile" in result["context"].lower()
+    assert_rag_result(result, **checks)
 
 
-@patch('cohere.Client')
-@patch('nodes.get_vector_store')
-def test_rag_03_president_query(mock_vectorstore, mock_cohere, mock_kalam_documents):
-    """Test 3: Query about Kalam's presidency."""
-    state = {
-        "question": "When did APJ Abdul Kalam serve as President?",
-        "route": "pdf",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
+@patch('nodes.search_documents_batch')
+def test_rag_10_error_handling(mock_search):
+    """Test 10: RAG error handling when vector store fails."""
+    state = {**RAG_STATE, "question": "Who was Kalam?"}
     
-    mock_docs = [Mock(page_content=doc) for doc in mock_kalam_documents]
-    mock_retriever = Mock()
-    mock_retriever.invoke.return_value = mock_docs
-    mock_vs = Mock()
-    mock_vs.as_retriever.return_value = mock_retriever
-    mock_vectorstore.return_value = mock_vs
-    
-    mock_cohere_client = Mock()
-    mock_results = [Mock(document=Mock(text=doc), relevance_score=0.9-i*0.05) 
-                   for i, doc in enumerate(mock_kalam_documents[:4])]
-    mock_rerank_response = Mock(results=mock_results)
-    mock_cohere_client.rerank.return_value = mock_rerank_response
-    mock_cohere.return_value = mock_cohere_client
+    mock_search.side_effect = Exception("Qdrant connection failed")
     
-    result = rag_retrieval_node(state)
+    result = asyncio.run(rag_retrieval_node(state))
     
-    assert "2002" in result["context"] or "President" in result["context"]
+    assert result["retrieved_docs"] == []
+    assert result["rerank_scores"] == []
+    assert "Error" in result["context"]
 
 
-@patch('cohere.Client')
-@patch('nodes.get_vector_store')
-def test_rag_04_books_query(mock_vectorstore, mock_cohere, mock_kalam_documents):
-    """Test 4: Query about Kalam's books."""
-    state = {
-        "question": "What books did Dr. Kalam write?",
-        "route": "pdf",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
+@patch('cohere.AsyncClient')
+@patch('nodes.search_documents_batch')
+def test_rag_11_literal_query_skips_rerank(mock_search, mock_cohere, vector_order_docs, kalam_search_results):
+    """Test 11: Quoted-phrase queries bypass Cohere reranking."""
+    state = {**RAG_STATE, "question": '"Wings of Fire"'}
     
-    mock_docs = [Mock(page_content=doc) for doc in mock_kalam_documents]
-    mock_retriever = Mock()
-    mock_retriever.invoke.return_value = mock_docs
-    mock_vs = Mock()
-    mock_vs.as_retriever.return_value = mock_retriever
-    mock_vectorstore.return_value = mock_vs
-    
-    mock_cohere_client = Mock()
-    mock_results = [Mock(document=Mock(text=mock_kalam_documents[5]), relevance_score=0.96),
-                   Mock(document=Mock(text=mock_kalam_documents[0]), relevance_score=0.88),
-                   Mock(document=Mock(text=mock_kalam_documents[1]), relevance_score=0.85),
-                   Mock(document=Mock(text=mock_kalam_documents[7]), relevance_score=0.82)]
-    mock_rerank_response = Mock(results=mock_results)
-    mock_cohere_client.rerank.return_value = mock_rerank_response
-    mock_cohere.return_value = mock_cohere_client
+    mock_search.return_value = kalam_search_results
     
-    result = rag_retrieval_node(state)
+    result = asyncio.run(rag_retrieval_node(state))
     
-    assert "Wings of Fire" in result["context"] or "books" in result["context"].lower()
+    mock_cohere.assert_not_called()
+    assert result["retrieved_docs"] == vector_order_docs
+    assert result["rerank_scores"] == []
 
 
-@patch('cohere.Client')
-@patch('nodes.get_vector_store')
-def test_rag_05_bharat_ratna_query(mock_vectorstore, mock_cohere, mock_kalam_documents):
-    """Test 5: Query about Bharat Ratna award."""
-    state = {
-        "question": "When did Kalam receive the Bharat Ratna?",
-        "route": "pdf",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_docs = [Mock(page_content=doc) for doc in mock_kalam_documents]
-    mock_retriever = Mock()
-    mock_retriever.invoke.return_value = mock_docs
-    mock_vs = Mock()
-    mock_vs.as_retriever.return_value = mock_retriever
-    mock_vectorstore.return_value = mock_vs
-    
-    mock_cohere_client = Mock()
-    mock_results = [Mock(document=Mock(text=doc), relevance_score=0.93-i*0.04) 
-                   for i, doc in enumerate(mock_kalam_documents[:4])]
-    mock_rerank_response = Mock(results=mock_results)
-    mock_cohere_client.rerank.return_value = mock_rerank_response
-    mock_cohere.return_value = mock_cohere_client
+@patch('cohere.AsyncClient')
+@patch('nodes.search_documents_batch')
+def test_rag_12_rerank_error_fallback(mock_search, mock_cohere, vector_order_docs, kalam_search_results):
+    """Test 12: Fall back to vector search order when Cohere fails."""
+    state = {**RAG_STATE, "question": "Who was APJ Abdul Kalam?"}
     
-    result = rag_retrieval_node(state)
+    mock_search.return_value = kalam_search_results
     
-    assert len(result["retrieved_docs"]) == 4
-    assert result["rerank_scores"][0] > 0.8
-
-
-@patch('cohere.Client')
-@patch('nodes.get_vector_store')
-def test_rag_06_birthplace_query(mock_vectorstore, mock_cohere, mock_kalam_documents):
-    """Test 6: Query about Kalam's birthplace."""
-    state = {
-        "question": "Where was APJ Abdul Kalam born?",
-        "route": "pdf",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_docs = [Mock(page_content=doc) for doc in mock_kalam_documents]
-    mock_retriever = Mock()
-    mock_retriever.invoke.return_value = mock_docs
-    mock_vs = Mock()
-    mock_vs.as_retriever.return_value = mock_retriever
-    mock_vectorstore.return_value = mock_vs
-    
-    mock_cohere_client = Mock()
-    mock_results = [Mock(document=Mock(text=doc), relevance_score=0.97-i*0.03) 
-                   for i, doc in enumerate(mock_kalam_documents[:4])]
-    mock_rerank_response = Mock(results=mock_results)
-    mock_cohere_client.rerank.return_value = mock_rerank_response
+    mock_cohere_client = AsyncMock()
+    mock_cohere_client.rerank.side_effect = Exception("Cohere unavailable")
     mock_cohere.return_value = mock_cohere_client
     
-    result = rag_retrieval_node(state)
+    result = asyncio.run(rag_retrieval_node(state))
     
-    assert "Rameswaram" in result["context"] or "Tamil Nadu" in result["context"]
+    assert result["retrieved_docs"] == vector_order_docs
+    assert result["rerank_scores"] == []
+    assert "Error" not in result["context"]
 
 
-@patch('cohere.Client')
-@patch('nodes.get_vector_store')
-def test_rag_07_death_query(mock_vectorstore, mock_cohere, mock_kalam_documents):
-    """Test 7: Query about Kalam's death."""
-    state = {
-        "question": "When and how did Dr. Kalam pass away?",
-        "route": "pdf",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_docs = [Mock(page_content=doc) for doc in mock_kalam_documents]
-    mock_retriever = Mock()
-    mock_retriever.invoke.return_value = mock_docs
-    mock_vs = Mock()
-    mock_vs.as_retriever.return_value = mock_retriever
-    mock_vectorstore.return_value = mock_vs
-    
-    mock_cohere_client = Mock()
-    # Specifically return document with death information first
-    mock_results = [
-        Mock(document=Mock(text=mock_kalam_documents[6]), relevance_score=0.98),  # "Dr. Kalam passed away on July 27, 2015..."
-        Mock(document=Mock(text=mock_kalam_documents[1]), relevance_score=0.88),
-        Mock(document=Mock(text=mock_kalam_documents[0]), relevance_score=0.85),
-        Mock(document=Mock(text=mock_kalam_documents[7]), relevance_score=0.82)
-    ]
-    mock_rerank_response = Mock(results=mock_results)
-    mock_cohere_client.rerank.return_value = mock_rerank_response
-    mock_cohere.return_value = mock_cohere_client
-    
-    result = rag_retrieval_node(state)
+@patch('cohere.AsyncClient')
+@patch('nodes.search_documents_batch')
+def test_rag_13_rerank_cache_hit(mock_search, mock_cohere, mock_kalam_documents, kalam_search_results):
+    """Test 13: Repeat queries reuse cached rerank scores instead of calling Cohere."""
+    state = {**RAG_STATE, "question": "Who was APJ Abdul Kalam?"}
     
-    # Verify death information is in context
-    assert "2015" in result["context"]
-    assert len(result["retrieved_docs"]) == 4
-
-
-@patch('cohere.Client')
-@patch('nodes.get_vector_store')
-def test_rag_08_isro_drdo_query(mock_vectorstore, mock_cohere, mock_kalam_documents):
-    """Test 8: Query about ISRO and DRDO work."""
-    state = {
-        "question": "What was Kalam's contribution to ISRO and DRDO?",
-        "route": "pdf",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
+    mock_search.return_value = kalam_search_results
     
-    mock_docs = [Mock(page_content=doc) for doc in mock_kalam_documents]
-    mock_retriever = Mock()
-    mock_retriever.invoke.return_value = mock_docs
-    mock_vs = Mock()
-    mock_vs.as_retriever.return_value = mock_retriever
-    mock_vectorstore.return_value = mock_vs
-    
-    mock_cohere_client = Mock()
-    mock_results = [Mock(document=Mock(text=doc), relevance_score=0.95-i*0.04) 
-                   for i, doc in enumerate(mock_kalam_documents[:4])]
-    mock_rerank_response = Mock(results=mock_results)
-    mock_cohere_client.rerank.return_value = mock_rerank_response
+    mock_cohere_client = AsyncMock()
+    mock_results = [SimpleNamespace(document=SimpleNamespace(text=doc), relevance_score=0.99-i*0.05)
+                   for i, doc in enumerate(mock_kalam_documents)]
+    mock_cohere_client.rerank.return_value = SimpleNamespace(results=mock_results)
     mock_cohere.return_value = mock_cohere_client
     
-    result = rag_retrieval_node(state)
+    first = asyncio.run(rag_retrieval_node(state))
+    second = asyncio.run(rag_retrieval_node(state))
     
-    assert len(result["retrieved_docs"]) > 0
-    assert all(score > 0 for score in result["rerank_scores"])
+    assert mock_cohere_client.rerank.call_count == 1
+    assert second["retrieved_docs"] == first["retrieved_docs"]
+    assert second["rerank_scores"] == first["rerank_scores"]
 
 
-@patch('cohere.Client')
-@patch('nodes.get_vector_store')
-def test_rag_09_rerank_scores_validation(mock_vectorstore, mock_cohere, mock_kalam_documents):
-    """Test 9: Validate reranking scores are properly returned."""
+@patch('cohere.AsyncClient')
+@patch('nodes.search_documents_batch')
+def test_rag_14_reuses_question_embedding(mock_search, mock_cohere, kalam_search_results):
+    """Test 14: A precomputed question embedding is passed straight to Qdrant."""
     state = {
-        "question": "Tell me about APJ Abdul Kalam",
-        "route": "pdf",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_docs = [Mock(page_content=doc) for doc in mock_kalam_documents]
-    mock_retriever = Mock()
-    mock_retriever.invoke.return_value = mock_docs
-    mock_vs = Mock()
-    mock_vs.as_retriever.return_value = mock_retriever
-    mock_vectorstore.return_value = mock_vs
-    
-    mock_cohere_client = Mock()
-    mock_results = [Mock(document=Mock(text=doc), relevance_score=0.99-i*0.02) 
-                   for i, doc in enumerate(mock_kalam_documents[:4])]
-    mock_rerank_response = Mock(results=mock_results)
-    mock_cohere_client.rerank.return_value = mock_rerank_response
-    mock_cohere.return_value = mock_cohere_client
-    
-    result = rag_retrieval_node(state)
-    
-    # Validate scores are in descending order
-    assert result["rerank_scores"] == sorted(result["rerank_scores"], reverse=True)
-    # Validate scores are between 0 and 1
-    assert all(0 <= score <= 1 for score in result["rerank_scores"])
-    # Validate we got 4 results
-    assert len(result["rerank_scores"]) == 4
-
-
-@patch('nodes.get_vector_store')
-def test_rag_10_error_handling(mock_vectorstore):
-    """Test 10: RAG error handling when vector store fails."""
-    state = {
-        "question": "Who was Kalam?",
-        "route": "pdf",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
+        **RAG_STATE,
+        "question": "Who was APJ Abdul Kalam?",
+        "question_embedding": [0.1, 0.2, 0.3]
     }
     
-    mock_vectorstore.side_effect = Exception("Qdrant connection failed")
+    mock_search.return_value = kalam_search_results
+    mock_cohere.return_value = AsyncMock()
+    mock_cohere.return_value.rerank.side_effect = Exception("Cohere unavailable")
     
-    result = rag_retrieval_node(state)
+    asyncio.run(rag_retrieval_node(state))
     
-    assert result["retrieved_docs"] == []
-    assert result["rerank_scores"] == []
-    assert "Error" in result["context"]
+    assert mock_search.call_args.kwargs["query_vectors"] == [[0.1, 0.2, 0.3]]
 
 
 # ============================================================================
-# 10 WEATHER API TESTS (Keep the same - they work fine)
+# 10 WEATHER API TESTS
 # ============================================================================
 
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_01_mumbai_success(mock_get, mock_from_messages, mock_get_llm, mock_parser):
-    """Test 1: Successful weather query for Mumbai."""
-    state = {
-        "question": "What's the weather in Mumbai?",
-        "route": "weather",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_response = Mock()
-    mock_response.json.return_value = {
-        "name": "Mumbai",
+def weather_payload(name: str, temp: float, feels_like: float, humidity: int, description: str, wind: float) -> dict:
+    """Build an OpenWeatherMap current-weather payload for an Indian city."""
+    return {
+        "name": name,
         "sys": {"country": "IN"},
-        "main": {"temp": 32, "feels_like": 35, "humidity": 70},
-        "weather": [{"description": "haze"}],
-        "wind": {"speed": 4.2}
-    }
-    mock_response.raise_for_status = Mock()
-    mock_get.return_value = mock_response
-    
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "Mumbai"
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = weather_node(state)
-    
-    assert "Mumbai" in result["context"]
-    assert "32" in result["context"]
-    assert result["weather_data"]["name"] == "Mumbai"
-
-
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_02_delhi_success(mock_get, mock_from_messages, mock_get_llm, mock_parser):
-    """Test 2: Successful weather query for Delhi."""
-    state = {
-        "question": "How's the weather in Delhi today?",
-        "route": "weather",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
+        "main": {"temp": temp, "feels_like": feels_like, "humidity": humidity},
+        "weather": [{"description": description}],
+        "wind": {"speed": wind}
     }
-    
-    mock_response = Mock()
-    mock_response.json.return_value = {
-        "name": "Delhi",
-        "sys": {"country": "IN"},
-        "main": {"temp": 18, "feels_like": 16, "humidity": 45},
-        "weather": [{"description": "clear sky"}],
-        "wind": {"speed": 3.1}
-    }
-    mock_response.raise_for_status = Mock()
-    mock_get.return_value = mock_response
-    
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "Delhi"
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = weather_node(state)
-    
-    assert "Delhi" in result["context"]
-    assert "18" in result["context"]
-
-
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_03_bangalore_success(mock_get, mock_from_messages, mock_get_llm, mock_parser):
-    """Test 3: Successful weather query for Bangalore."""
-    state = {
-        "question": "Tell me the weather in Bangalore",
-        "route": "weather",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_response = Mock()
-    mock_response.json.return_value = {
-        "name": "Bangalore",
-        "sys": {"country": "IN"},
-        "main": {"temp": 24, "feels_like": 23, "humidity": 60},
-        "weather": [{"description": "partly cloudy"}],
-        "wind": {"speed": 2.5}
-    }
-    mock_response.raise_for_status = Mock()
-    mock_get.return_value = mock_response
-    
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "Bangalore"
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = weather_node(state)
-    
-    assert "Bangalore" in result["context"]
-    assert "weather_data" in result
-
-
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_04_kolkata_humidity(mock_get, mock_from_messages, mock_get_llm, mock_parser):
-    """Test 4: Weather query for Kolkata with humidity check."""
-    state = {
-        "question": "What's the humidity in Kolkata?",
-        "route": "weather",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_response = Mock()
-    mock_response.json.return_value = {
-        "name": "Kolkata",
-        "sys": {"country": "IN"},
-        "main": {"temp": 29, "feels_like": 32, "humidity": 85},
-        "weather": [{"description": "humid"}],
-        "wind": {"speed": 2.8}
-    }
-    mock_response.raise_for_status = Mock()
-    mock_get.return_value = mock_response
-    
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "Kolkata"
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = weather_node(state)
-    
-    assert "85" in result["context"]
-    assert "Humidity" in result["context"]
-
-
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_05_chennai_temperature(mock_get, mock_from_messages, mock_get_llm, mock_parser):
-    """Test 5: Weather query for Chennai with temperature validation."""
-    state = {
-        "question": "What's the temperature in Chennai?",
-        "route": "weather",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_response = Mock()
-    mock_response.json.return_value = {
-        "name": "Chennai",
-        "sys": {"country": "IN"},
-        "main": {"temp": 31, "feels_like": 34, "humidity": 75},
-        "weather": [{"description": "sunny"}],
-        "wind": {"speed": 5.5}
-    }
-    mock_response.raise_for_status = Mock()
-    mock_get.return_value = mock_response
-    
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "Chennai"
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = weather_node(state)
-    
-    assert "31" in result["context"]
-    assert "Temperature" in result["context"]
-
-
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_06_api_timeout_error(mock_get, mock_from_messages, mock_get_llm, mock_parser):
+
+
+def make_weather_response(payload: dict) -> SimpleNamespace:
+    """Stub a successful httpx response returning the given payload."""
+    return SimpleNamespace(json=lambda: payload, raise_for_status=lambda: None)
+
+
+# (question, OpenWeatherMap payload, substrings expected in the context)
+WEATHER_CASES = [
+    pytest.param(
+        "What's the weather in Mumbai?",
+        weather_payload("Mumbai", 32, 35, 70, "haze", 4.2),
+        ("Mumbai", "32"),
+        id="01_mumbai_success"
+    ),
+    pytest.param(
+        "How's the weather in Delhi today?",
+        weather_payload("Delhi", 18, 16, 45, "clear sky", 3.1),
+        ("Delhi", "18"),
+        id="02_delhi_success"
+    ),
+    pytest.param(
+        "Tell me the weather in Bangalore",
+        weather_payload("Bangalore", 24, 23, 60, "partly cloudy", 2.5),
+        ("Bangalore",),
+        id="03_bangalore_success"
+    ),
+    pytest.param(
+        "What's the humidity in Kolkata?",
+        weather_payload("Kolkata", 29, 32, 85, "humid", 2.8),
+        ("85", "Humidity"),
+        id="04_kolkata_humidity"
+    ),
+    pytest.param(
+        "What's the temperature in Chennai?",
+        weather_payload("Chennai", 31, 34, 75, "sunny", 5.5),
+        ("31", "Temperature"),
+        id="05_chennai_temperature"
+    ),
+    pytest.param(
+        "What's the wind speed in Hyderabad?",
+        weather_payload("Hyderabad", 27, 28, 55, "windy", 8.5),
+        ("8.5", "Wind Speed"),
+        id="08_wind_speed_check"
+    ),
+    pytest.param(
+        "How does it feel in Ahmedabad?",
+        weather_payload("Ahmedabad", 35, 38, 40, "hot", 4.0),
+        ("38", "Feels Like"),
+        id="09_feels_like_temperature"
+    ),
+    pytest.param(
+        "Weather report for Jaipur",
+        weather_payload("Jaipur", 22, 20, 50, "pleasant", 3.2),
+        # Complete response structure
+        ("Location:", "Temperature:", "Feels Like:", "Humidity:", "Weather:", "Wind Speed:"),
+        id="10_response_structure_validation"
+    ),
+]
+
+
+@pytest.mark.parametrize("question,payload,expected", WEATHER_CASES)
+def test_weather_query(mock_weather_api, question, payload, expected):
+    """Tests 1-5, 8-10: Successful weather queries produce a complete context."""
+    state = {**WEATHER_STATE, "question": question}
+    
+    mock_weather_api.get.return_value = make_weather_response(payload)
+    mock_weather_api.chain.ainvoke.return_value = payload["name"]
+    
+    result = asyncio.run(weather_node(state))
+    
+    assert result["weather_data"] == payload
+    for substring in expected:
+        assert substring in result["context"]
+
+
+def test_weather_06_api_timeout_error(mock_weather_api):
     """Test 6: Handle API timeout error."""
-    state = {
-        "question": "Weather in Pune?",
-        "route": "weather",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_get.side_effect = Exception("Timeout error")
+    state = {**WEATHER_STATE, "question": "Weather in Pune?"}
     
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "Pune"
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
+    mock_weather_api.get.side_effect = Exception("Timeout error")
+    mock_weather_api.chain.ainvoke.return_value = "Pune"
     
-    result = weather_node(state)
+    result = asyncio.run(weather_node(state))
     
     assert "Error" in result["context"]
     assert result["weather_data"] == {}
 
 
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_07_invalid_city_error(mock_get, mock_from_messages, mock_get_llm, mock_parser):
+def test_weather_07_invalid_city_error(mock_weather_api):
     """Test 7: Handle invalid city name error."""
-    state = {
-        "question": "Weather in InvalidCity123?",
-        "route": "weather",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
+    state = {**WEATHER_STATE, "question": "Weather in InvalidCity123?"}
     
-    mock_response = Mock()
-    mock_response.raise_for_status.side_effect = Exception("City not found")
-    mock_get.return_value = mock_response
+    def raise_for_status():
+        raise Exception("City not found")
     
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "InvalidCity123"
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
+    mock_weather_api.get.return_value = SimpleNamespace(raise_for_status=raise_for_status)
+    mock_weather_api.chain.ainvoke.return_value = "InvalidCity123"
     
-    result = weather_node(state)
+    result = asyncio.run(weather_node(state))
     
     assert "Error" in result["context"]
 
 
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_08_wind_speed_check(mock_get, mock_from_messages, mock_get_llm, mock_parser):
-    """Test 8: Weather query with wind speed validation."""
-    state = {
-        "question": "What's the wind speed in Hyderabad?",
-        "route": "weather",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_response = Mock()
-    mock_response.json.return_value = {
-        "name": "Hyderabad",
-        "sys": {"country": "IN"},
-        "main": {"temp": 27, "feels_like": 28, "humidity": 55},
-        "weather": [{"description": "windy"}],
-        "wind": {"speed": 8.5}
-    }
-    mock_response.raise_for_status = Mock()
-    mock_get.return_value = mock_response
-    
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "Hyderabad"
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = weather_node(state)
-    
-    assert "8.5" in result["context"]
-    assert "Wind Speed" in result["context"]
-
-
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_09_feels_like_temperature(mock_get, mock_from_messages, mock_get_llm, mock_parser):
-    """Test 9: Weather query with 'feels like' temperature."""
-    state = {
-        "question": "How does it feel in Ahmedabad?",
-        "route": "weather",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_response = Mock()
-    mock_response.json.return_value = {
-        "name": "Ahmedabad",
-        "sys": {"country": "IN"},
-        "main": {"temp": 35, "feels_like": 38, "humidity": 40},
-        "weather": [{"description": "hot"}],
-        "wind": {"speed": 4.0}
-    }
-    mock_response.raise_for_status = Mock()
-    mock_get.return_value = mock_response
-    
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "Ahmedabad"
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = weather_node(state)
-    
-    assert "38" in result["context"]
-    assert "Feels Like" in result["context"]
-
-
-@patch('nodes.StrOutputParser')
-@patch('nodes.get_llm')
-@patch('nodes.ChatPromptTemplate.from_messages')
-@patch('nodes.requests.get')
-def test_weather_10_response_structure_validation(mock_get, mock_from_messages, mock_get_llm, mock_parser):
-    """Test 10: Validate complete weather response structure."""
-    state = {
-        "question": "Weather report for Jaipur",
-        "route": "weather",
-        "context": "",
-        "weather_data": {},
-        "retrieved_docs": [],
-        "rerank_scores": [],
-        "generation": "",
-        "evaluation": {}
-    }
-    
-    mock_response = Mock()
-    mock_response.json.return_value = {
-        "name": "Jaipur",
-        "sys": {"country": "IN"},
-        "main": {"temp": 22, "feels_like": 20, "humidity": 50},
-        "weather": [{"description": "pleasant"}],
-        "wind": {"speed": 3.2}
-    }
-    mock_response.raise_for_status = Mock()
-    mock_get.return_value = mock_response
-    
-    mock_chain = MagicMock()
-    mock_chain.invoke.return_value = "Jaipur"
-    mock_prompt = MagicMock()
-    mock_llm = MagicMock()
-    mock_parser_inst = MagicMock()
-    mock_from_messages.return_value = mock_prompt
-    mock_get_llm.return_value = mock_llm
-    mock_parser.return_value = mock_parser_inst
-    mock_prompt.__or__.return_value = mock_llm
-    mock_llm.__or__.return_value = mock_chain
-    
-    result = weather_node(state)
-    
-    # Validate all required fields are present
-    assert "context" in result
-    assert "weather_data" in result
-    assert "Location:" in result["context"]
-    assert "Temperature:" in result["context"]
-    assert "Feels Like:" in result["context"]
-    assert "Humidity:" in result["context"]
-    assert "Weather:" in result["context"]
-    assert "Wind Speed:" in result["context"]
-
-
 # ============================================================================
 # RUN TESTS
 # ============================================================================
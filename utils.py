@@ -1,119 +1,502 @@
 import fitz  # PyMuPDF
+import numpy as np
 import os
-from typing import List
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+import uuid
+import mmap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import chain, repeat
+from collections import defaultdict
+from typing import Callable, List, Optional
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
 from langchain_qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient
-from qdrant_client.models import Distance, VectorParams
-from config import QDRANT_URL, QDRANT_COLLECTION, OPENAI_API_KEY
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from qdrant_client.models import (
+    Distance, VectorParams, QueryRequest, OptimizersConfigDiff, PointStruct,
+    Filter, FieldCondition, MatchValue, PayloadSchemaType
+)
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from cachetools import TTLCache
+from config import (
+    QDRANT_URL,
+    QDRANT_COLLECTION,
+    QDRANT_PREFER_GRPC,
+    QDRANT_GRPC_PORT,
+    OPENAI_API_KEY,
+    QDRANT_MAX_CONCURRENT_REQUESTS,
+    QDRANT_SEARCH_BATCH_SIZE,
+    EMBEDDING_CACHE_MAXSIZE,
+    EMBEDDING_CACHE_TTL,
+    EMBEDDING_BACKEND,
+    OPENAI_EMBEDDING_MODEL,
+    LOCAL_EMBEDDING_MODEL,
+    LOCAL_EMBEDDING_DIR,
+    EMBEDDING_DIM,
+    PDF_EXTRACT_WORKERS,
+    PDF_MIN_PAGES_PER_WORKER,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_MAX_WORKERS,
+    QDRANT_UPLOAD_BATCH_SIZE,
+    QDRANT_UPLOAD_CONCURRENCY,
+    INGEST_MAX_BATCHES_IN_FLIGHT,
+    QDRANT_INDEXING_THRESHOLD,
+    EMBEDDING_USE_BATCH_API,
+    EMBEDDING_BATCH_API_MIN_CHUNKS,
+    EMBEDDING_BATCH_API_POLL_INTERVAL
+)
 
 
-def extract_text_from_pdf(pdf_path: str) -> str:
-    """Extract text from PDF using PyMuPDF."""
-    doc = fitz.open(pdf_path)
-    text = ""
-    for page in doc:
-        text += page.get_text()
-    doc.close()
-    return text
+log = logging.getLogger(__name__)
 
+# Bounds concurrent searches from graph runs in the API thread pool
+search_semaphore = threading.BoundedSemaphore(QDRANT_MAX_CONCURRENT_REQUESTS)
 
-def create_vector_store(pdf_path: str):
-    """Create and populate Qdrant vector store with PDF embeddings."""
-    # Extract and split text
-    text = extract_text_from_pdf(pdf_path)
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len
+# Query embeddings keyed by hash of the query text, so repeated questions skip
+# the embeddings API call
+embedding_cache = TTLCache(maxsize=EMBEDDING_CACHE_MAXSIZE, ttl=EMBEDDING_CACHE_TTL)
+embedding_cache_lock = threading.Lock()
+
+# Payload field holding the hash of the PDF a chunk came from
+DOC_HASH_KEY = f"{QdrantVectorStore.METADATA_KEY}.doc_hash"
+
+# Plain text only: no image blocks, and ligatures expanded to their letters
+PDF_TEXT_FLAGS = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_MEDIABOX_CLIP
+
+
+@lru_cache(maxsize=1)
+def get_text_splitter() -> RecursiveCharacterTextSplitter:
+    """Get the splitter shared by every ingest, counting lengths in embedding-model tokens.
+    
+    Built on first use, so importing utils doesn't load the tiktoken encoding.
+    """
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        model_name=OPENAI_EMBEDDING_MODEL,
+        chunk_size=400,
+        chunk_overlap=50
     )
-    chunks = text_splitter.split_text(text)
+
+
+@contextmanager
+def open_pdf(pdf_path: str):
+    """Open a PDF over a read-only memory map of the file.
     
-    # Create Document objects
-    from langchain_core.documents import Document
-    documents = [Document(page_content=chunk) for chunk in chunks]
+    PyMuPDF reads the mapped pages in place, so extraction workers opening
+    the same file share the OS page cache instead of each buffering a copy.
+    """
+    with open(pdf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+        with fitz.open(stream=view, filetype="pdf") as doc:
+            yield doc
+
+
+def split_page_range(pdf_path: str, start: int, end: int,
+                     text_splitter: Optional[RecursiveCharacterTextSplitter] = None) -> List[str]:
+    """Split a contiguous range of PDF pages into chunks, one page at a time (runs in a worker process)."""
+    text_splitter = text_splitter or get_text_splitter()
+    chunks = []
+    with open_pdf(pdf_path) as doc:
+        for i in range(start, end):
+            chunks.extend(text_splitter.split_text(doc[i].get_text("text", flags=PDF_TEXT_FLAGS)))
+    return chunks
+
+
+def split_pdf(pdf_path: str, num_workers: int = PDF_EXTRACT_WORKERS,
+              text_splitter: Optional[RecursiveCharacterTextSplitter] = None) -> List[str]:
+    """Extract text from PDF using PyMuPDF and split it into chunks.
     
-    # Initialize embeddings
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-3-small",
+    Each page is split as soon as it is extracted, so the whole document's
+    text is never held as one string (chunks don't span page breaks).
+    Large PDFs are split into contiguous page ranges that worker processes
+    handle in parallel (each reopens the file; PyMuPDF documents can't be
+    pickled). Small PDFs are handled in-process.
+    
+    text_splitter defaults to the shared tiktoken splitter, which each worker
+    builds for itself; one passed in must be picklable.
+    """
+    with open_pdf(pdf_path) as doc:
+        page_count = doc.page_count
+        num_workers = min(num_workers, page_count // PDF_MIN_PAGES_PER_WORKER)
+    if num_workers <= 1:
+        return split_page_range(pdf_path, 0, page_count, text_splitter)
+    
+    bounds = [page_count * i // num_workers for i in range(num_workers + 1)]
+    # Spawn (not fork): the API process already runs Qdrant gRPC and thread pools
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return list(chain.from_iterable(
+            pool.map(split_page_range, repeat(pdf_path), bounds[:-1], bounds[1:], repeat(text_splitter))
+        ))
+
+
+@lru_cache(maxsize=1)
+def get_qdrant_client() -> QdrantClient:
+    """Get the shared Qdrant client (one connection pool per process).
+    
+    Built on first use, and without the server-version probe, so importing
+    the app (e.g. in the gunicorn master) opens no connections.
+    """
+    return QdrantClient(
+        url=QDRANT_URL, prefer_grpc=QDRANT_PREFER_GRPC, grpc_port=QDRANT_GRPC_PORT, check_compatibility=False
+    )
+
+
+@lru_cache(maxsize=1)
+def get_embeddings() -> Embeddings:
+    """Get the embeddings model used for both documents and queries (built once per process)."""
+    if EMBEDDING_BACKEND == "onnx":
+        from local_embeddings import OnnxEmbeddings
+        return OnnxEmbeddings(LOCAL_EMBEDDING_MODEL, LOCAL_EMBEDDING_DIR)
+    return OpenAIEmbeddings(
+        model=OPENAI_EMBEDDING_MODEL,
         openai_api_key=OPENAI_API_KEY
     )
+
+
+def reset_clients():
+    """Close the shared Qdrant client and drop the cached clients built on it.
+    
+    The next call to get_qdrant_client, get_embeddings or get_vector_store
+    builds fresh ones, e.g. in a worker forked after the master ingested.
+    """
+    if get_qdrant_client.cache_info().currsize:
+        get_qdrant_client().close()
+    get_qdrant_client.cache_clear()
+    get_embeddings.cache_clear()
+    get_vector_store.cache_clear()
+
+
+def embed_texts_batch_api(texts: List[str]) -> np.ndarray:
+    """Embed document chunks through the OpenAI Batch API, blocking until the job finishes.
+    
+    Each request line carries up to EMBEDDING_BATCH_SIZE distinct chunks; its
+    custom_id is the offset of its first chunk, so results can be matched back
+    whatever order the output file lists them in. Returns one float32 row per
+    text: a whole corpus of vectors is held at once, and Python float lists
+    would take several times the memory.
+    """
+    from openai import OpenAI
+    
+    client = OpenAI(api_key=OPENAI_API_KEY)
+    unique = list(dict.fromkeys(texts))
+    lines = [
+        json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/embeddings",
+            "body": {"model": OPENAI_EMBEDDING_MODEL, "input": unique[i:i + EMBEDDING_BATCH_SIZE]}
+        })
+        for i in range(0, len(unique), EMBEDDING_BATCH_SIZE)
+    ]
+    input_file = client.files.create(file=("embeddings.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/embeddings", completion_window="24h")
+    log.info("📝 Submitted embeddings batch %s with %d chunks", batch.id, len(unique))
+    
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(EMBEDDING_BATCH_API_POLL_INTERVAL)
+        batch = client.batches.retrieve(batch.id)
+    if batch.status != "completed" or batch.request_counts.failed:
+        raise RuntimeError(f"Embeddings batch {batch.id} ended with status {batch.status}")
+    
+    vectors = np.empty((len(unique), EMBEDDING_DIM), dtype=np.float32)
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        result = json.loads(line)
+        start = int(result["custom_id"])
+        for item in result["response"]["body"]["data"]:
+            vectors[start + item["index"]] = item["embedding"]
+    rows = {text: i for i, text in enumerate(unique)}
+    return vectors[[rows[text] for text in texts]]
+
+
+async def ingest_chunks_async(
+    chunks: List[str],
+    embed_documents: Callable[[List[str]], List[List[float]]],
+    doc_hash: str
+):
+    """Embed chunks and upload them to Qdrant as a pipeline.
+    
+    Several embedding batches run at once in a thread pool, and each batch is
+    upserted as soon as its vectors arrive, so uploads overlap the batches
+    still being embedded. A batch counts as in flight until its upload
+    finishes, so when Qdrant is slower than embedding, new batches wait
+    instead of piling up vectors in memory. Identical chunks (e.g. repeated headers and footers)
+    are embedded once but stored once per occurrence. Payloads use the layout
+    QdrantVectorStore reads. Point ids derive from the PDF hash and chunk
+    position, so ingesting the same PDF twice (e.g. from several API workers
+    starting at once) overwrites the same points instead of duplicating them.
+    """
+    positions = defaultdict(list)
+    for i, chunk in enumerate(chunks):
+        positions[chunk].append(i)
+    unique = list(positions)
+    metadata = {"doc_hash": doc_hash}
+    loop = asyncio.get_running_loop()
+    client = AsyncQdrantClient(
+        url=QDRANT_URL, prefer_grpc=QDRANT_PREFER_GRPC, grpc_port=QDRANT_GRPC_PORT, check_compatibility=False
+    )
+    semaphore = asyncio.Semaphore(QDRANT_UPLOAD_CONCURRENCY)
+    batch_semaphore = asyncio.Semaphore(INGEST_MAX_BATCHES_IN_FLIGHT)
+    
+    async def upsert(points: List[PointStruct]):
+        async with semaphore:
+            await client.upsert(collection_name=QDRANT_COLLECTION, points=points)
     
-    # Initialize Qdrant client
-    client = QdrantClient(url=QDRANT_URL)
+    async def upload(batch: List[str], vectors: List[List[float]]):
+        points = [
+            PointStruct(
+                id=str(uuid.uuid5(uuid.NAMESPACE_OID, f"{doc_hash}:{i}")),
+                vector=vector,
+                payload={QdrantVectorStore.CONTENT_KEY: chunk, QdrantVectorStore.METADATA_KEY: metadata}
+            )
+            for chunk, vector in zip(batch, vectors)
+            for i in positions[chunk]
+        ]
+        await asyncio.gather(*(
+            upsert(points[i:i + QDRANT_UPLOAD_BATCH_SIZE])
+            for i in range(0, len(points), QDRANT_UPLOAD_BATCH_SIZE)
+        ))
+    
+    async def embed_and_upload(batch: List[str], pool: ThreadPoolExecutor):
+        async with batch_semaphore:
+            vectors = await loop.run_in_executor(pool, embed_documents, batch)
+            await upload(batch, vectors)
     
-    # Check if collection exists
     try:
+        with ThreadPoolExecutor(max_workers=EMBEDDING_MAX_WORKERS) as pool:
+            await asyncio.gather(*(
+                embed_and_upload(unique[i:i + EMBEDDING_BATCH_SIZE], pool)
+                for i in range(0, len(unique), EMBEDDING_BATCH_SIZE)
+            ))
+    finally:
+        await client.close()
+
+
+def ingest_chunks(chunks: List[str], embeddings: Embeddings, doc_hash: str):
+    """Embed and upload chunks from sync code (ingestion runs in a worker thread, off the event loop).
+    
+    Large OpenAI ingests are embedded up front through the Batch API when enabled.
+    """
+    embed_documents = embeddings.embed_documents
+    if EMBEDDING_USE_BATCH_API and EMBEDDING_BACKEND == "openai" and len(chunks) > EMBEDDING_BATCH_API_MIN_CHUNKS:
+        vectors = dict(zip(chunks, embed_texts_batch_api(chunks)))
+        embed_documents = lambda texts: [vectors[text].tolist() for text in texts]
+    asyncio.run(ingest_chunks_async(chunks, embed_documents, doc_hash))
+
+
+def pdf_hash(pdf_path: str) -> str:
+    """Hash the PDF's bytes, so re-ingesting an unchanged file can be detected."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(pdf_path, "rb") as f:
+        # Read in 1 MiB blocks so large PDFs aren't loaded whole
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_ingested(client: QdrantClient, doc_hash: str) -> bool:
+    """Check whether chunks of the PDF with this hash are already stored."""
+    doc_filter = Filter(must=[FieldCondition(key=DOC_HASH_KEY, match=MatchValue(value=doc_hash))])
+    return client.count(collection_name=QDRANT_COLLECTION, count_filter=doc_filter).count > 0
+
+
+def embed_queries(queries: List[str]) -> List[List[float]]:
+    """Embed several queries in a single batched API call, reusing cached embeddings."""
+    keys = [hashlib.sha1(query.strip().encode("utf-8")).hexdigest() for query in queries]
+    with embedding_cache_lock:
+        vectors = [embedding_cache.get(key) for key in keys]
+    
+    # Only send queries without a cached embedding to the API
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        new_vectors = get_embeddings().embed_documents([queries[i] for i in missing])
+        with embedding_cache_lock:
+            for i, vector in zip(missing, new_vectors):
+                embedding_cache[keys[i]] = vector
+                vectors[i] = vector
+    
+    return vectors
+
+
+def set_indexing_threshold(client: QdrantClient, threshold: int):
+    """Set the collection's HNSW indexing threshold (0 turns indexing off)."""
+    client.update_collection(
+        collection_name=QDRANT_COLLECTION,
+        optimizer_config=OptimizersConfigDiff(indexing_threshold=threshold)
+    )
+
+
+def restore_indexing(client: QdrantClient):
+    """Turn HNSW indexing back on after a bulk upload, even one that failed.
+    
+    An ingest that failed or crashed mid-way would otherwise leave the
+    collection at indexing_threshold=0, where every search is a full scan.
+    """
+    try:
+        set_indexing_threshold(client, QDRANT_INDEXING_THRESHOLD)
+    except Exception as e:
+        # Don't mask the error that brought us here (e.g. Qdrant unreachable)
+        log.warning("⚠️ Could not restore Qdrant indexing threshold: %s", e)
+
+
+def create_doc_hash_index(client: QdrantClient):
+    """Index the doc-hash payload field, so is_ingested counts without a full scan."""
+    client.create_payload_index(
+        collection_name=QDRANT_COLLECTION,
+        field_name=DOC_HASH_KEY,
+        field_schema=PayloadSchemaType.KEYWORD
+    )
+
+
+def create_vector_store(pdf_path: str):
+    """Create and populate Qdrant vector store with PDF embeddings.
+    
+    If the collection already holds this PDF's chunks, the PDF is not read or
+    re-embedded. Indexing is only touched by the process that turned it off
+    for its bulk upload, or when an earlier ingest crashed and left it off.
+    """
+    embeddings = get_embeddings()
+    client = get_qdrant_client()
+    doc_hash = pdf_hash(pdf_path)
+    
+    # Check if collection exists before doing any PDF work
+    if client.collection_exists(QDRANT_COLLECTION):
         collection_info = client.get_collection(QDRANT_COLLECTION)
-        existing_count = collection_info.points_count
+        indexing_off = collection_info.config.optimizer_config.indexing_threshold == 0
+        # Collections created by older builds have no doc-hash index yet
+        if DOC_HASH_KEY not in collection_info.payload_schema:
+            create_doc_hash_index(client)
         
-        if existing_count > 0:
-            print(f"✅ Using existing Qdrant collection with {existing_count} documents")
+        if collection_info.points_count > 0 and is_ingested(client, doc_hash):
+            log.info("✅ Using existing Qdrant collection with %d documents", collection_info.points_count)
+            if indexing_off:
+                restore_indexing(client)
             vectorstore = QdrantVectorStore(
                 client=client,
                 collection_name=QDRANT_COLLECTION,
                 embedding=embeddings
             )
             return vectorstore
-        else:
-            print("📝 Adding documents to empty collection")
-    except Exception as e:
-        print(f"📝 Creating new collection: {e}")
-        # Create collection if not exists
-        client.create_collection(
-            collection_name=QDRANT_COLLECTION,
-            vectors_config=VectorParams(size=1536, distance=Distance.COSINE)
-        )
-    
-    # Create vector store from documents
-    vectorstore = QdrantVectorStore.from_documents(
-        documents=documents,
-        embedding=embeddings,
-        url=QDRANT_URL,
-        collection_name=QDRANT_COLLECTION,
-        force_recreate=False
-    )
+        
+        log.info("📝 Adding %s to collection with %d documents", pdf_path, collection_info.points_count)
+        if collection_info.points_count == 0 and not indexing_off:
+            # HNSW indexing off until the bulk upload is done
+            set_indexing_threshold(client, 0)
+            indexing_off = True
+    else:
+        log.info("📝 Creating new collection: %s", QDRANT_COLLECTION)
+        # Create collection, with HNSW indexing off until the bulk upload is done
+        try:
+            client.create_collection(
+                collection_name=QDRANT_COLLECTION,
+                vectors_config=VectorParams(size=EMBEDDING_DIM, distance=Distance.COSINE),
+                optimizers_config=OptimizersConfigDiff(indexing_threshold=0)
+            )
+            indexing_off = True
+        except Exception:
+            # Another process created it first and restores indexing after its
+            # own upload; ingesting again is harmless because point ids are deterministic
+            if not client.collection_exists(QDRANT_COLLECTION):
+                raise
+            indexing_off = False
+        create_doc_hash_index(client)
+    
+    try:
+        # Extract and split text
+        chunks = split_pdf(pdf_path)
+        
+        # Embed in concurrent batches, uploading each batch as soon as it is embedded
+        ingest_chunks(chunks, embeddings, doc_hash)
+    finally:
+        if indexing_off:
+            restore_indexing(client)
     
-    print(f"✅ Created Qdrant vector store with {len(documents)} documents")
+    # The upload just succeeded against this collection, so its config needs no re-check
+    vectorstore = get_vector_store()
+    
+    log.info("✅ Created Qdrant vector store with %d documents", len(chunks))
     
     return vectorstore
 
 
+@lru_cache(maxsize=1)
 def get_vector_store():
-    """Get existing Qdrant vector store."""
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-3-small",
-        openai_api_key=OPENAI_API_KEY
-    )
-    
-    client = QdrantClient(url=QDRANT_URL)
+    """Get the shared Qdrant vector store for the existing collection.
     
+    Built once per process without LangChain's collection-config validation,
+    which would otherwise cost a Qdrant round-trip and a dummy embedding call
+    per search. create_vector_store validates the collection at startup.
+    """
     vectorstore = QdrantVectorStore(
-        client=client,
+        client=get_qdrant_client(),
         collection_name=QDRANT_COLLECTION,
-        embedding=embeddings
+        embedding=get_embeddings(),
+        validate_collection_config=False
     )
     
     return vectorstore
 
 
-def add_documents_to_store(pdf_path: str):
-    """Add new documents to existing Qdrant store."""
-    text = extract_text_from_pdf(pdf_path)
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len
-    )
-    chunks = text_splitter.split_text(text)
+def search_documents_batch(
+    queries: List[str],
+    k: int,
+    query_vectors: Optional[List[List[float]]] = None
+) -> List[List[Document]]:
+    """Search Qdrant for several queries in a single batched round-trip.
+    
+    Pass precomputed query_vectors to skip embedding the queries again.
+    """
+    vectorstore = get_vector_store()
     
-    from langchain_core.documents import Document
-    documents = [Document(page_content=chunk) for chunk in chunks]
+    # Embed all uncached queries in one API call
+    if query_vectors is None:
+        query_vectors = embed_queries(queries)
     
+    requests = [
+        QueryRequest(query=vector, using=vectorstore.vector_name, limit=k, with_payload=True)
+        for vector in query_vectors
+    ]
+    # Send requests in fixed-size groups, with at most a few groups in flight
+    responses = []
+    for i in range(0, len(requests), QDRANT_SEARCH_BATCH_SIZE):
+        with search_semaphore:
+            responses.extend(vectorstore.client.query_batch_points(
+                collection_name=QDRANT_COLLECTION,
+                requests=requests[i:i + QDRANT_SEARCH_BATCH_SIZE]
+            ))
+    
+    return [
+        [
+            Document(
+                page_content=point.payload.get(vectorstore.content_payload_key, ""),
+                metadata=point.payload.get(vectorstore.metadata_payload_key) or {}
+            )
+            for point in response.points
+        ]
+        for response in responses
+    ]
+
+
+def add_documents_to_store(pdf_path: str):
+    """Add new documents to existing Qdrant store.
+    
+    A PDF whose content was already ingested is skipped without re-embedding.
+    """
     vectorstore = get_vector_store()
-    vectorstore.add_documents(documents)
+    doc_hash = pdf_hash(pdf_path)
+    if is_ingested(vectorstore.client, doc_hash):
+        log.info("✅ %s already ingested, skipping", pdf_path)
+        return vectorstore
+    
+    chunks = split_pdf(pdf_path)
+    ingest_chunks(chunks, vectorstore.embeddings, doc_hash)
     
-    print(f"✅ Added {len(documents)} new documents to Qdrant store")
+    log.info("✅ Added %d new documents to Qdrant store", len(chunks))
     
     return vectorstore